@@ -2,7 +2,7 @@
 #
 # Basic toolbox for server operations; wraps up a lot of stuff to avoid the need for hardcoding on the user's side.
 
-import socket, time, warnings
+import asyncio, multiprocessing as mp, queue, socket, threading, time, types, warnings
 import numpy as np
 import matplotlib.pyplot as plt
 
@@ -10,12 +10,124 @@ from local_config import ip_address, port, fpga_clk_freq_MHz, grad_board
 import grad_board as gb
 import server_comms as sc
 import marcompile as fc
+import marcache as mc
 
 import pdb
 st = pdb.set_trace
 
 ######## TODO: configure the final buffers as well, whether in marcompile or elsewhere
 
+# Conversion done by Experiment.flo2int() for each floating-point dictionary key
+flo2int_key_types = {
+    **{k: 'tx_real' for k in ['tx0_i', 'tx0_q', 'tx1_i', 'tx1_q']},
+    **{k: 'tx_complex' for k in ['tx0', 'tx1']},
+    # marcompile will figure out whether the key matches the selected grad board
+    **{k: 'grad' for k in ['grad_vx', 'grad_vy', 'grad_vz', 'grad_vz2',
+                           'fhdo_vx', 'fhdo_vy', 'fhdo_vz', 'fhdo_vz2',
+                           'ocra1_vx', 'ocra1_vy', 'ocra1_vz', 'ocra1_vz2'] + [f'ocra40_v{i}' for i in range(40)]},
+    **{k: 'rx_rate' for k in ['rx0_rate', 'rx1_rate', 'rx2_rate', 'rx3_rate']},
+    **{k: 'binary' for k in ['rx0_rate_valid', 'rx1_rate_valid', 'rx2_rate_valid', 'rx3_rate_valid',
+                             'rx0_rst_n', 'rx1_rst_n', 'rx2_rst_n', 'rx3_rst_n',
+                             'rx0_en', 'rx1_en', 'rx2_en', 'rx3_en',
+                             'tx_gate', 'rx_gate', 'trig_out']},
+    'leds': 'leds'
+}
+
+def decimate(times, vals, tolerance, min_interval=0):
+    """Choose the samples of one or more waveforms on a shared time
+    axis to keep, so that holding each kept sample until the next one
+    (as the TX and gradient outputs do) stays within tolerance of every
+    sample. The last sample is kept if it changes the output at all,
+    since it is held indefinitely.
+
+    times: increasing float array
+    vals: float array of size (channels x times), or 1D for a single waveform
+    tolerance: maximum error, either for all channels or one per channel
+    min_interval: minimum time between kept samples, in the same units as times;
+    where the waveform changes faster, the tolerance cannot be met
+
+    Returns a boolean array, True for the samples to keep"""
+    times, vals = np.asarray(times), np.atleast_2d(vals)
+    tol = np.broadcast_to(np.reshape(tolerance, (-1, 1)), (vals.shape[0], 1))
+    n = times.size
+    keep = np.zeros(n, dtype=bool)
+    if n == 0:
+        return keep
+
+    # for every sample, the first of the next few samples which is outside the tolerance of it, or -1
+    ahead = min(16, n - 1)
+    nxt = np.full(n, -1, dtype=np.int64)
+    for d in range(ahead, 0, -1): # nearer samples overwrite further ones
+        out = np.flatnonzero(np.any(np.abs(vals[:, d:] - vals[:, :-d]) > tol, axis=0))
+        nxt[out] = out + d
+    nxt = nxt.tolist()
+    earliest = np.searchsorted(times, times + min_interval).tolist() if min_interval else None
+
+    def search(i):
+        # first later sample outside the tolerance, beyond the ones checked above, searching in growing windows
+        j, win = i + ahead + 1, 16
+        while j < n:
+            out = np.any(np.abs(vals[:, j:j + win] - vals[:, i:i + 1]) > tol, axis=0)
+            if out.any():
+                return j + int(np.argmax(out))
+            j, win = j + win, 2 * win
+        return n
+
+    # follow the chain of kept samples; only the long flat stretches need searching
+    kept, i = [], 0
+    while i < n:
+        kept.append(i)
+        j = nxt[i] if nxt[i] >= 0 else search(i)
+        if j < n and min_interval:
+            j = max(j, earliest[i]) # don't update sooner than the minimum interval allows
+        i = j
+    keep[kept] = True
+
+    if np.any(vals[:, -1] != vals[:, np.flatnonzero(keep)[-1]]):
+        keep[-1] = True
+    return keep
+
+def decode_rx(i_data, q_data, norm_factor, dtype=np.complex128, alloc=None):
+    """Convert the I and Q samples of an RX channel, as sent by the
+    server, into a complex array scaled by norm_factor.
+
+    The samples can either be lists of integers, or raw byte strings of
+    little-endian 32-bit integers; byte strings are read without
+    copying, and in both cases I and Q are written straight into the
+    output array.
+
+    alloc: optional function returning the complex output array for a
+    given number of samples, e.g. space in an RxSink; dtype is then ignored"""
+    def samples(data):
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            return np.frombuffer(data, dtype='<i4')
+        return np.array(data).astype(np.int32)
+
+    i_samples, q_samples = samples(i_data), samples(q_data)
+    assert i_samples.size == q_samples.size, "RX I and Q data have different lengths"
+    rx = np.empty(i_samples.size, dtype=dtype) if alloc is None else alloc(i_samples.size)
+    np.multiply(i_samples, norm_factor, out=rx.real, casting='same_kind')
+    np.multiply(q_samples, norm_factor, out=rx.imag, casting='same_kind')
+    return rx
+
+def envelope(t, y, n_bins):
+    """Indices of the samples of a step waveform needed to plot it at a
+    resolution of n_bins time bins: the first, last, minimum and maximum
+    samples in each bin, so that no peaks are lost.
+
+    t: increasing time array; y: values, the same size as t"""
+    if t.size == 0:
+        return np.zeros(0, dtype=np.int64)
+    bins = np.minimum(((t - t[0]) * (n_bins / max(t[-1] - t[0], 1e-30))).astype(np.int64), n_bins - 1)
+    starts = np.flatnonzero(np.concatenate([[True], bins[1:] != bins[:-1]]))
+    ends = np.concatenate([starts[1:], [t.size]]) - 1
+    # order by value within each bin; the first and last of each are then the minimum and maximum
+    by_value = np.lexsort((y, bins))
+    return np.unique(np.concatenate([starts, ends, by_value[starts], by_value[ends]]))
+
+# Gradient board class for each grad_board setting in local_config.py
+gradb_classes = {'ocra1': gb.OCRA1, 'ocra40': gb.OCRA40, 'gpa-fhdo': gb.GPAFHDO}
+
 class Experiment:
     """Wrapper class for managing an entire experimental sequence
 
@@ -55,6 +167,25 @@ class Experiment:
 
     init_gpa: initialise the GPA during the construction of this class
 
+    offline: don't connect to the server until it is first needed, and
+    initialise the GPA (and halt_and_reset) then instead; compile() and
+    get_flodict() never need the server, so sequences can be compiled on
+    machines without any hardware
+
+    template_keys: TX and gradient keys (such as 'tx0' or 'ocra40_v3')
+    whose values, but not times, will be changed between runs. The
+    sequence is compiled once, and new values passed to add_flodict()
+    with append=False are then written straight into the machine code
+    without recompiling, as long as their times haven't changed.
+
+    timing, timing_callback: record where the time goes in each run.
+    The record is a dictionary with the wall time in seconds of each
+    phase since the previous run ('add_flodict', 'flo2int', 'compile',
+    'dict2segs', 'segs2bin', 'run_seq' and 'rx_decode'; nested phases
+    overlap), the bytes sent and received and the number of server round
+    trips, and the instruction and RX sample counts of the run. It is
+    stored in last_run_stats and passed to timing_callback, if given.
+
     """
 
     def __init__(self,
@@ -63,7 +194,7 @@ class Experiment:
                  seq_dict=None,
                  seq_csv=None,
                  rx_lo=0, # which of internal NCO local oscillators (LOs), out of 0, 1, 2, to use for each channel
-                 grad_max_update_rate=0.2, # MSPS, across all channels in parallel, best-effort
+                 grad_max_update_rate=None, # MSPS, across all channels in parallel, best-effort; 0.2 by default, or the session's rate
                  gpa_fhdo_offset_time=0, # when GPA-FHDO is used, offset the Y, Z and Z2 gradient times by 1x, 2x and 3x this value to emulate 'simultaneous' updates
                  print_infos=True, # show server info messages
                  assert_errors=True, # halt on server errors
@@ -76,16 +207,45 @@ class Experiment:
                  allow_user_init_cfg=False, # allow user-defined alteration of marga configuration set by init, namely RX rate, LO properties etc; see the compile() method for details
                  halt_and_reset=False, # upon connecting to the server, halt any existing sequences that may be running
                  flush_old_rx=False, # when debugging or developing new code, you may accidentally fill up the RX FIFOs - they will not automatically be cleared in case there is important data inside. Setting this true will always read them out and clear them before running a sequence. More advanced manual code can read RX from existing sequences.
+                 template_keys=(), # keys whose values can be changed without recompiling, as long as their timing stays the same
+                 rx_dtype=np.complex128, # type of the RX data returned by run(); np.complex64 halves the memory needed for long acquisitions
+                 rx_sink=None, # rx_sink.RxSink to write the RX data of each run into, instead of keeping it in memory
+                 timing=False, # record the wall time of each phase, the bytes transferred and the instruction count for each run, in last_run_stats
+                 timing_callback=None, # function called with the timing record at the end of each run; enables timing
+                 offline=False, # only connect to the server (and initialise the GPA or halt_and_reset) when the first command is sent, so that sequences can be compiled without any hardware
+                 session=None, # Session to share the connection, gradient board and hardware initialisation of; grad_max_update_rate and prev_socket are then taken from it, and can't be given differently
+                 async_connection=None, # server_comms.AsyncConnection to use instead of a socket (not with a session or prev_socket), for run_async(); the server initialisation is then deferred as in offline mode
                  ):
 
+        # timing record of the phases since the last run, or None if timing is disabled
+        self._timing = {} if timing or timing_callback is not None else None
+        self._timing_callback = timing_callback
+        self.last_run_stats = None
+
         # create socket early so that destructor works
         self._close_socket = True
-        if prev_socket is None:
-            self._s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self._s.connect( (ip_address, port) )
-        else:
+        self._s = None # connected on first use in offline mode
+        self._session = session
+        self._aconn = async_connection
+        if async_connection is not None:
+            assert session is None and prev_socket is None, "Cannot use a session or prev_socket together with an async_connection"
+            self._close_socket = False
+            offline = True # blocking commands can't be sent until there's a worker thread to send them from
+        elif session is not None:
+            self._close_socket = False # the session owns the socket
+            assert grad_max_update_rate in (None, session.grad_max_update_rate), \
+                "grad_max_update_rate {:g} conflicts with the session's {:g}".format(grad_max_update_rate, session.grad_max_update_rate)
+            assert prev_socket is None, "Cannot use prev_socket together with a session"
+            grad_max_update_rate = session.grad_max_update_rate
+            if not offline:
+                self._connect()
+        elif prev_socket is not None:
             self._s = prev_socket
             self._close_socket = False # do not close previous socket
+        elif not offline:
+            self._connect()
+        if grad_max_update_rate is None:
+            grad_max_update_rate = 0.2
 
         self.set_lo_freq(lo_freq)
 
@@ -100,27 +260,32 @@ class Experiment:
             rx_lo = rx_lo, rx_lo # extend to 2 elements
         self._rx_lo = rx_lo
 
-        assert grad_board in ('ocra1', 'gpa-fhdo', 'ocra40'), "Unknown gradient board!"
-        if grad_board == 'ocra1':
-            gradb_class = gb.OCRA1
-            self._gpa_fhdo_offset_time = 0
-        elif grad_board == 'ocra40':
-            gradb_class = gb.OCRA40
-            self._gpa_fhdo_offset_time = 0
+        assert grad_board in gradb_classes, "Unknown gradient board!"
+        self._gpa_fhdo_offset_time = gpa_fhdo_offset_time if grad_board == 'gpa-fhdo' else 0
+        if session is not None:
+            self.gradb = SessionGradb(session.gradb, self.server_command, self.server_command_batch)
         else:
-            gradb_class = gb.GPAFHDO
-            self._gpa_fhdo_offset_time = gpa_fhdo_offset_time
-        self.gradb = gradb_class(self.server_command, grad_max_update_rate)
+            self.gradb = gradb_classes[grad_board](self.server_command, grad_max_update_rate, self.server_command_batch)
 
         if initial_wait is None:
             # auto-set the initial wait to be long enough for initial gradient configuration to finish, plus 1us for miscellaneous startup
             self._initial_wait = 1 + 1/grad_max_update_rate
 
         self._auto_leds = auto_leds
+        self._rx_dtype = rx_dtype
+        self._rx_sink = rx_sink
 
         assert (seq_csv is None) or (seq_dict is None), "Cannot supply both a sequence dictionary and a CSV file."
         self._csv = None
         self._seq = None
+        self._seq_chunks = {} # values added to each key of the sequence, not yet joined up
+        self._dirty_keys = set() # sequence keys changed since the last compile
+        self._compile_cache = {} # per-key changelists and per-buffer segments from previous compiles
+        self._key_digests = {} # per-key hashes for the on-disk compile cache, see marcache.dict_key()
+        self._template_keys = template_keys
+        self._template = None # where the template key values are in the machine code
+        self._repeats = None # (integer block dictionary, repeats, period in cycles)
+        self._decimation_stats = None # (samples before, samples after) for the last decimated dictionary
         if seq_dict is not None:
             self.add_flodict(seq_dict)
         elif seq_csv is not None:
@@ -129,12 +294,11 @@ class Experiment:
         self._print_infos = print_infos
         self._assert_errors = assert_errors
 
-        if init_gpa:
-            self.gradb.init_hw()
-
-        if halt_and_reset:
-            halted = sc.command({'halt_and_reset': 0}, self._s)[0][4]['halt_and_reset']
-            assert halted, "Could not halt the execution of an existing sequence. Please file a bug report."
+        self._init_gpa = init_gpa
+        self._halt_and_reset = halt_and_reset
+        self._server_init_pending = offline # server initialisation is deferred until the first command
+        if not offline:
+            self._init_server()
 
         self._fix_cic_scale = fix_cic_scale
         self._set_cic_shift = set_cic_shift
@@ -142,11 +306,71 @@ class Experiment:
         self._allow_user_init_cfg = allow_user_init_cfg
 
     def __del__(self):
-        if self._close_socket:
+        if self._close_socket and self._s is not None:
             self._s.close()
 
+    def _connect(self):
+        if self._session is not None:
+            self._s = self._session.socket()
+            return
+        self._s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._s.connect( (ip_address, port) )
+
+    def _init_server(self):
+        """ Hardware setup done when the server is first used; only done once per session """
+        session = self._session
+        if self._init_gpa and not (session is not None and session.gpa_initialised):
+            self.gradb.init_hw()
+            if session is not None:
+                session.gpa_initialised = True
+
+        if self._halt_and_reset and not (session is not None and session.halted):
+            halted = self._plain_command({'halt_and_reset': 0})[0][4]['halt_and_reset']
+            assert halted, "Could not halt the execution of an existing sequence. Please file a bug report."
+            if session is not None:
+                session.halted = True
+
+    def _init_pending_server(self):
+        if self._server_init_pending:
+            self._server_init_pending = False
+            self._init_server()
+
+    def _socket(self):
+        """ Socket to the server; in offline mode, connect and initialise the server on first use """
+        assert self._aconn is None, "An Experiment with an async_connection doesn't use a socket; send commands over the connection instead"
+        if self._s is None:
+            self._connect()
+        self._init_pending_server()
+        return self._s
+
     def server_command(self, server_dict):
-        return sc.command(server_dict, self._s, self._print_infos, self._assert_errors)
+        if self._aconn is not None:
+            self._init_pending_server()
+            return self._aconn.sync_command(server_dict, self._print_infos, self._assert_errors, self._timing)
+        return sc.command(server_dict, self._socket(), self._print_infos, self._assert_errors, self._timing)
+
+    def server_command_batch(self, server_dicts):
+        if self._aconn is not None:
+            self._init_pending_server()
+            return self._aconn.sync_command_batch(server_dicts, self._print_infos, self._assert_errors, self._timing)
+        return sc.command_batch(server_dicts, self._socket(), self._print_infos, self._assert_errors, self._timing)
+
+    def _plain_command(self, server_dict, record=None):
+        """ Server command without showing infos or asserting on errors """
+        if record is None:
+            record = self._timing
+        if self._aconn is not None:
+            self._init_pending_server()
+            return self._aconn.sync_command(server_dict, stats=record)
+        return sc.command(server_dict, self._socket(), stats=record)
+
+    def _time_phase(self, phase, t0, record=None):
+        """ Add the wall time since t0 to a phase of the current timing record, or of record if given """
+        if record is None:
+            record = self._timing
+        if record is not None:
+            phases = record.setdefault('phases', {})
+            phases[phase] = phases.get(phase, 0) + time.perf_counter() - t0
 
     def get_rx_ts(self):
         return self._rx_ts
@@ -165,9 +389,19 @@ class Experiment:
 
         self._seq_compiled = False # force recompilation
 
-    def flo2int(self, seq_dict):
+    def flo2int(self, seq_dict, tolerances=None):
         """Convert a floating-point sequence dictionary to an integer binary
-        dictionary"""
+        dictionary
+
+        tolerances: optional maximum error for approximating the TX and
+        gradient waveforms with fewer samples (see decimate()); either
+        a single value, or a dictionary of values for some TX and gradient
+        keys (other keys raise a ValueError). Template keys are never
+        decimated. """
+
+        t0 = time.perf_counter()
+        if tolerances is not None:
+            seq_dict = self._decimate_flodict(seq_dict, tolerances)
 
         intdict = {}
 
@@ -180,57 +414,76 @@ class Experiment:
             """ farr: float array, [-1, 1] """
             return np.round(32767 * farr).astype(np.uint16)
 
-        def tx_complex(times, farr, tolerance=2e-6):
+        def tx_complex(times, farr, tolerance=2e-6, strip=True):
             """times: float time array, farr: complex float array, [-1-1j, 1+1j]
             tolerance: minimum difference two values need to be considered binary-unique (2e-6 corresponds to ~19 bits)
+            strip: remove repeated elements; disabled for template keys, so that the times don't depend on the values
             -- returns a tuple with repeated elements removed"""
             idata, qdata = farr.real, farr.imag
             unique = lambda k: np.concatenate([[True], np.abs(np.diff(k)) > tolerance])
-            # DEBUGGING: use the below lambda instead to avoid stripping repeated values
-            # unique = lambda k: np.ones_like(k, dtype=bool)
+            # keep repeated values if requested (also useful for debugging)
+            if not strip:
+                unique = lambda k: np.ones_like(k, dtype=bool)
             idata_u, qdata_u = unique(idata), unique(qdata)
             tbins = ( times_us(times[idata_u] + self._initial_wait), times_us(times[qdata_u] + self._initial_wait) )
             txbins = ( tx_real(idata[idata_u]), tx_real(qdata[qdata_u]) )
             return tbins, txbins
 
+        # convert all the gradient channels at once, with their values stacked together
+        grad_keys = [k for k in seq_dict if flo2int_key_types.get(k) == 'grad']
+        grad_bins = {}
+        if grad_keys:
+            keybs, channels = zip(*(self.gradb.key_convert(k) for k in grad_keys))
+            channels = np.array(channels, dtype=np.uint32)
+            gvals = [np.asarray(seq_dict[k][1]) for k in grad_keys]
+            if all(v.ndim == 1 and v.size == gvals[0].size for v in gvals):
+                gvalbins = self.gradb.float2bin(np.stack(gvals), channels[:, None]) # one row per channel
+            else:
+                lengths = [v.size for v in gvals]
+                gvalbins = np.split(self.gradb.float2bin(np.concatenate(gvals), np.repeat(channels, lengths)), np.cumsum(lengths)[:-1])
+
+            # channels sharing a time axis only need it converted once
+            gtbins = []
+            for k, channel in zip(grad_keys, channels):
+                times = seq_dict[k][0]
+                if self._gpa_fhdo_offset_time:
+                    # hack to de-synchronise GPA-FHDO outputs, to give the
+                    # user the illusion of being able to output on several
+                    # channels in parallel
+                    gtbins.append(times_us(times + int(channel)*self._gpa_fhdo_offset_time + self._initial_wait))
+                elif gtbins and (times is prev_times or np.array_equal(times, prev_times)):
+                    gtbins.append(gtbins[-1])
+                else:
+                    gtbins.append(times_us(times + self._initial_wait))
+                prev_times = times
+            grad_bins = {k: (kb, t, v) for k, kb, t, v in zip(grad_keys, keybs, gtbins, gvalbins)}
+
         for key, (times, vals) in seq_dict.items():
             # each possible dictionary entry returns a tuple (even if one element) for the binary dictionary to send to marcompile
-            tbin = times_us(times + self._initial_wait),
-            if key in ['tx0_i', 'tx0_q', 'tx1_i', 'tx1_q']:
+            key_type = flo2int_key_types.get(key)
+            if key_type == 'tx_real':
+                tbin = times_us(times + self._initial_wait),
                 valbin = tx_real(vals),
                 keybin = key,
-            elif key in ['tx0', 'tx1']:
-                tbin, valbin = tx_complex(times, vals)
+            elif key_type == 'tx_complex':
+                tbin, valbin = tx_complex(times, vals, strip=key not in self._template_keys)
                 keybin = key + '_i', key + '_q'
-            elif key in ['grad_vx', 'grad_vy', 'grad_vz', 'grad_vz2',
-                         'fhdo_vx', 'fhdo_vy', 'fhdo_vz', 'fhdo_vz2',
-                         'ocra1_vx', 'ocra1_vy', 'ocra1_vz', 'ocra1_vz2'] + [f'ocra40_v{i}' for i in range(40)]:
-                # marcompile will figure out whether the key matches the selected grad board
-                keyb, channel = self.gradb.key_convert(key)
-                keybin = keyb, # tuple
-                valbin = self.gradb.float2bin(vals, channel),
-
-                # hack to de-synchronise GPA-FHDO outputs, to give the
-                # user the illusion of being able to output on several
-                # channels in parallel
-                if self._gpa_fhdo_offset_time:
-                    tbin = times_us(times + channel*self._gpa_fhdo_offset_time + self._initial_wait),
-
-            elif key in ['rx0_rate', 'rx1_rate', 'rx2_rate', 'rx3_rate']:
+            elif key_type == 'grad':
+                keyb, t, v = grad_bins[key]
+                tbin, valbin, keybin = (t,), (v,), (keyb,)
+            elif key_type == 'rx_rate':
+                tbin = times_us(times + self._initial_wait),
                 keybin = key,
                 valbin = vals.astype(np.uint16),
-            elif key in [
-                    'rx0_rate_valid', 'rx1_rate_valid', 'rx2_rate_valid', 'rx3_rate_valid',
-                    'rx0_rst_n', 'rx1_rst_n', 'rx2_rst_n', 'rx3_rst_n',
-                    'rx0_en', 'rx1_en', 'rx2_en', 'rx3_en', 
-                    'tx_gate', 'rx_gate', 'trig_out'
-                ]:
+            elif key_type == 'binary':
+                tbin = times_us(times + self._initial_wait),
                 keybin = key,
                 # binary-valued data
                 valbin = vals.astype(np.int32),
                 for vb in valbin:
                     assert np.all( (0 <= vb) & (vb <= 1) ), "Binary columns must be [0,1] or [False, True] valued"
-            elif key in ['leds']:
+            elif key_type == 'leds':
+                tbin = times_us(times + self._initial_wait),
                 keybin = key,
                 valbin = vals.astype(np.int32),
             else:
@@ -240,8 +493,58 @@ class Experiment:
             for t, k, v in zip(tbin, keybin, valbin):
                 intdict[k] = (t, v)
 
+        self._time_phase('flo2int', t0)
         return intdict
 
+    def _decimate_flodict(self, seq_dict, tolerances):
+        """ Remove the TX and gradient samples which can be left out within tolerances, and report the reduction """
+        decimated_types = ('tx_real', 'tx_complex', 'grad')
+        if not isinstance(tolerances, dict):
+            tolerances = {k: tolerances for k in seq_dict if flo2int_key_types.get(k) in decimated_types}
+        for k in tolerances:
+            if flo2int_key_types.get(k) not in decimated_types:
+                # the digital outputs and RX settings must keep every edge
+                raise ValueError("Only TX and gradient keys can be decimated, not {!r}".format(k))
+
+        # gradient updates share one SPI bus, so leave at least the gap marcompile needs between them
+        spi_div = (self.gradb.bin_config['initial_bufs'][0] & 0xfc) >> 2
+        grad_interval = (24 * (1 + spi_div) + 3) / fpga_clk_freq_MHz
+
+        # decimate gradient channels on the same time axis together, so that their updates stay simultaneous
+        groups = []
+        for k in tolerances:
+            if k in self._template_keys or k not in seq_dict:
+                continue
+            times = seq_dict[k][0]
+            if flo2int_key_types.get(k) == 'grad':
+                for g in groups:
+                    if flo2int_key_types.get(g[0]) == 'grad' and (seq_dict[g[0]][0] is times or np.array_equal(seq_dict[g[0]][0], times)):
+                        g.append(k)
+                        break
+                else:
+                    groups.append([k])
+            else:
+                groups.append([k])
+
+        seq_dict = dict(seq_dict)
+        n_before = n_after = 0
+        for g in groups:
+            times = np.asarray(seq_dict[g[0]][0])
+            vals = np.stack([np.asarray(seq_dict[k][1]) for k in g])
+            tol = np.array([tolerances[k] for k in g], dtype=float)
+            if np.iscomplexobj(vals): # I and Q are separate outputs, each held independently
+                vals, tol = np.concatenate([vals.real, vals.imag]), np.concatenate([tol, tol])
+            keep = decimate(times, vals, tol, grad_interval if flo2int_key_types[g[0]] == 'grad' else 0)
+            for k in g:
+                seq_dict[k] = (times[keep], np.asarray(seq_dict[k][1])[keep])
+            n_before += len(g) * times.size
+            n_after += len(g) * int(np.count_nonzero(keep))
+
+        self._decimation_stats = (n_before, n_after)
+        if self._print_infos and n_before:
+            print("Decimation: kept {:d} of {:d} TX/gradient samples ({:.1f}x fewer)".format(n_after, n_before, n_before / max(n_after, 1)))
+        return seq_dict
+
     def add_intdict(self, seq_intdict, append=True):
         """ Add an integer-format dictionary to the sequence, or replace the old (time, value) tuples with new ones """
         if self._seq is None:
@@ -249,17 +552,114 @@ class Experiment:
 
         for name, sb in seq_intdict.items():
             if name in self._seq.keys() and append:
-                a, b = self._seq[name]
-                self._seq[name] = ( np.append(a, sb[0]), np.append(b, sb[1]) )
+                # only join the chunks up when the sequence is next read, to avoid copying it every time
+                self._seq_chunks.setdefault(name, [self._seq[name]]).append(sb)
+            elif name in self._seq.keys() and name not in self._seq_chunks \
+                 and all(np.array_equal(x, y) for x, y in zip(self._seq[name], sb)):
+                continue # unchanged, no need to recompile it
             else:
                 self._seq[name] = sb
+                self._seq_chunks.pop(name, None)
+            self._dirty_keys.add(name)
+
+    def _join_seq_chunks(self):
+        """ Join up the values added to each key of the sequence since it was last read """
+        for name, chunks in self._seq_chunks.items():
+            if isinstance(name, tuple): # gradient block, one row of values per channel
+                vals = np.concatenate([np.atleast_2d(c[1]) for c in chunks], axis=1)
+            else:
+                vals = np.concatenate([np.ravel(c[1]) for c in chunks])
+            self._seq[name] = ( np.concatenate([np.ravel(c[0]) for c in chunks]), vals )
+        self._seq_chunks.clear()
 
-    def add_flodict(self, flodict, append=True):
-        """ Add a floating-point dictionary to the sequence """
+    def add_flodict(self, flodict, append=True, tolerances=None):
+        """ Add a floating-point dictionary to the sequence
+
+        tolerances: optional lossy decimation of the TX and gradient waveforms, see flo2int() """
         assert self._csv is None, "Cannot replace the dictionary for an Experiment class created from a CSV"
-        self.add_intdict(self.flo2int(flodict), append)
+        t0 = time.perf_counter()
+        intdict = self.flo2int(flodict, tolerances)
+        if not append and self._seq_compiled and self._template is not None and not self._seq_chunks \
+           and all(k in self._template and np.array_equal(t, self._seq[k][0]) for k, (t, v) in intdict.items()):
+            # only template values have changed, so write them straight into the machine code
+            fc.patch_template(self._machine_code, self._template, intdict)
+            self._seq.update(intdict)
+            self._time_phase('add_flodict', t0)
+            return
+
+        self.add_intdict(intdict, append)
+        self._seq_compiled = False
+        self._time_phase('add_flodict', t0)
+
+    def add_grad_block(self, times, values, keys=None, append=True, tolerance=None):
+        """ Add the waveforms for several gradient channels sharing one time axis.
+        The block is converted and compiled as a whole, which is much faster
+        than adding each channel to a floating-point dictionary separately.
+
+        times: increasing float array, times in us
+        values: float array of size (channels x times), one row per channel
+        keys: gradient dictionary keys of the rows, e.g. ['ocra40_v0', 'ocra40_v1']; by default the first rows of the grad board's keys
+        tolerance: optional maximum error for decimating the block, see decimate() """
+        assert self._csv is None, "Cannot replace the dictionary for an Experiment class created from a CSV"
+        times, values = np.asarray(times), np.atleast_2d(values)
+        if keys is None:
+            keys = list(self.gradb.keys())[:values.shape[0]]
+        assert values.shape == (len(keys), times.size), "Block values must have one row per key and one column per time"
+        assert np.all(np.diff(times) > 0), "Block times must be increasing"
+
+        if tolerance is not None:
+            assert not set(keys) & set(self._template_keys), "Cannot decimate template keys"
+            d = self._decimate_flodict({k: (times, v) for k, v in zip(keys, values)}, tolerance)
+            times, values = d[keys[0]][0], np.stack([d[k][1] for k in keys])
+
+        if self._gpa_fhdo_offset_time:
+            # each channel has its own time axis, so the block can't be kept together
+            self.add_flodict({k: (times, v) for k, v in zip(keys, values)}, append)
+            return
+
+        keybs, channels = zip(*(self.gradb.key_convert(k) for k in keys))
+        tbin = np.round(fpga_clk_freq_MHz * (times + self._initial_wait)).astype(np.int64)
+        valbin = self.gradb.float2bin(values, np.array(channels, dtype=np.uint32)[:, None])
+        self.add_intdict({tuple(keybs): (tbin, valbin)}, append)
+        self._seq_compiled = False
+
+    def set_repeats(self, block_flodict, repeats, period):
+        """ Set a block of the sequence (e.g. one TR) to be repeated several
+        times. Only a few repeats of the block are compiled and the rest
+        are tiled, so this is much faster than adding every repeat to the
+        sequence; the rest of the sequence may overlap with the first two
+        repeats, but must end before the last change of the second repeat
+        (compile() checks this).
+
+        block_flodict: floating-point dictionary for the first repeat
+        repeats: total number of repeats
+        period: delay between repeats, in us; rounded to the nearest clock cycle """
+        assert self._csv is None, "Cannot add a repeated block to an Experiment class created from a CSV"
+        assert not self._template_keys, "Cannot use repeated blocks together with template keys"
+        self._repeats = self.flo2int(block_flodict), repeats, int(np.round(fpga_clk_freq_MHz * period))
         self._seq_compiled = False
 
+    def _cic_config(self):
+        """ Set CIC decimation rate and internal shift, if necessary, and calculate CIC scale correction;
+        returns the rate words for RX0/2 and RX1/3 """
+        rx0_words, self._rx0_cic_factor = fc.cic_words(self._rx_divs[0], self._set_cic_shift)
+        rx1_words, self._rx1_cic_factor = fc.cic_words(self._rx_divs[1], self._set_cic_shift)
+        if not self._fix_cic_scale: # clear the correction factor
+            self._rx0_cic_factor = 1
+            self._rx1_cic_factor = 1
+        return rx0_words, rx1_words
+
+    def load_compiled(self, machine_code):
+        """ Run machine code compiled elsewhere, e.g. by compile_batch()
+        with the same RX settings as this Experiment, instead of the
+        sequence on the next run(). The sequence dictionary isn't
+        changed, so get_flodict() and plot_sequence() don't show it, and
+        adding to the sequence recompiles it as before. """
+        self._cic_config()
+        self._machine_code = np.array(machine_code, dtype=np.uint32)
+        self._template = None
+        self._seq_compiled = True
+
     def compile(self):
         """Convert either dictionary or CSV file into machine code, with
         extra machine code at the start to ensure the system is initialised to
@@ -268,6 +668,7 @@ class Experiment:
         Initially, configure the RX rates and set the LEDs.
         Remainder of the sequence will be as programmed.
         """
+        t0 = time.perf_counter()
 
         # RX and LO configuration
         tstart = 50 # cycles before doing anything
@@ -286,12 +687,7 @@ class Experiment:
                        'lo2_rst': ( np.array([tstart, tstart + 1]), np.array([1, 0]) )
                        }
 
-        # Set CIC decimation rate and internal shift, if necessary, and calculate CIC scale correction
-        rx0_words, self._rx0_cic_factor = fc.cic_words(self._rx_divs[0], self._set_cic_shift)
-        rx1_words, self._rx1_cic_factor = fc.cic_words(self._rx_divs[1], self._set_cic_shift)
-        if not self._fix_cic_scale: # clear the correction factor
-            self._rx0_cic_factor = 1
-            self._rx1_cic_factor = 1
+        rx0_words, rx1_words = self._cic_config()
         rx0r_st = tstart + rx_wait
         wds = len(rx0_words)
         ar0 = np.arange(wds, dtype=int)
@@ -318,6 +714,16 @@ class Experiment:
             initial_cfg.update({ 'rx1_lo': ( np.array([tstart]), np.array([self._rx_lo[1]]) ) })
             initial_cfg.update({ 'rx3_lo': ( np.array([tstart]), np.array([self._rx_lo[1]]) ) })
 
+        self._join_seq_chunks()
+
+        if self._repeats is not None and self._repeats[1] > 5 and self._seq:
+            # only a few repeats are compiled, so nothing else can happen once they start to be tiled
+            block, repeats, period = self._repeats
+            block_end = max(np.max(t) for t, v in block.values()) + period
+            seq_end = max(np.max(t) for t, v in self._seq.values())
+            assert seq_end < block_end, "The rest of the sequence ends at {:.3f} us, but must end before the last change of the second repeated block at {:.3f} us".format(
+                seq_end / fpga_clk_freq_MHz - self._initial_wait, block_end / fpga_clk_freq_MHz - self._initial_wait)
+
         # Automatic LED scan
         if self._auto_leds:
             led_steps = 256
@@ -337,53 +743,118 @@ class Experiment:
 
         # do not clear relevant dictionary values if user-defined configuration of init parameters at runtime is allowed
         self.add_intdict(initial_cfg, append=self._allow_user_init_cfg)
-
-        self._machine_code = np.array( fc.dict2bin(self._seq,
-                                             self.gradb.bin_config['initial_bufs'],
-                                             self.gradb.bin_config['latencies'], # TODO: can add extra manipulation here, e.g. add to another array etc
-                                             ), dtype=np.uint32 )
+        self._join_seq_chunks()
+
+        initial_bufs = self.gradb.bin_config['initial_bufs']
+        latencies = self.gradb.bin_config['latencies'] # TODO: can add extra manipulation here, e.g. add to another array etc
+        if self._template_keys:
+            # keep track of where the template key values end up, so that they can be patched later
+            int_keys = []
+            for k in self._template_keys:
+                if k in ['tx0', 'tx1']:
+                    int_keys += [k + '_i', k + '_q']
+                elif k.split('_')[0] in ('grad', 'fhdo', 'ocra1', 'ocra40'):
+                    int_keys.append(self.gradb.key_convert(k)[0])
+                else:
+                    int_keys.append(k)
+            self._machine_code, self._template = fc.dict2template(self._seq, int_keys, initial_bufs, latencies)
+            self._dirty_keys.clear()
+        elif self._repeats is not None:
+            # compile a few repeats of the block, and tile the rest
+            block, repeats, period = self._repeats
+            self._machine_code = fc.dict2bin_repeats(self._seq, block, repeats, period, initial_bufs, latencies)
+        else:
+            # reuse the program from an earlier session if it's in the on-disk cache
+            cache_key = None
+            if mc.compile_cache_dir:
+                for k in self._dirty_keys:
+                    self._key_digests.pop(k, None) # only rehash the keys changed since the last compile
+                cache_key = mc.dict_key(self._seq, initial_bufs, latencies, self._key_digests)
+            self._machine_code = mc.load(cache_key) if cache_key else None # read-only memory map if found
+            if self._machine_code is None:
+                # only the keys changed since the last compile are rebuilt, the rest of the buffers are reused from the cache
+                t1 = time.perf_counter()
+                segs = fc.dict2segs(self._seq, initial_bufs, latencies, cache=self._compile_cache, dirty=self._dirty_keys)
+                self._dirty_keys.clear()
+                self._time_phase('dict2segs', t1)
+                t1 = time.perf_counter()
+                self._machine_code = fc.segs2bin(segs, initial_bufs)
+                self._time_phase('segs2bin', t1)
+                if cache_key:
+                    mc.store(cache_key, self._machine_code)
 
         self._seq_compiled = True
+        self._time_phase('compile', t0)
 
-    def get_flodict(self, intd=None):
+    def get_flodict(self, intd=None, keys=None, t_range=None):
         """Calculate floating-point dictionaries based on the data inside the
-        Experiment class so far -- useful for plotting or testing the sequence"""
+        Experiment class so far -- useful for plotting or testing the sequence
+
+        keys: only convert these output keys, e.g. ['tx0_i', 'ocra40_v3'], rather than all of them
+        t_range: only convert the changes within (t_start, t_end) in us, plus
+        the last change before t_start to give the value held at the start"""
 
         if intd is None:
             if not self._seq_compiled:
                 self.compile()
 
+            self._join_seq_chunks()
             intd = self._seq
 
+        wanted = lambda k: keys is None or k in keys
+
+        # split gradient blocks up into their channels
+        if any(isinstance(k, tuple) for k in intd):
+            intd = dict(intd)
+            for block_keys in [k for k in intd if isinstance(k, tuple)]:
+                t_bin, vals = intd.pop(block_keys)
+                intd.update({k: (t_bin, v) for k, v in zip(block_keys, vals) if wanted(k)})
+
+        if t_range is not None:
+            t_lo, t_hi = np.round(fpga_clk_freq_MHz * (np.asarray(t_range) + self._initial_wait))
+
         flodict = {}
 
-        def convert_t(t_bin, y):
+        def convert_t(t_bin, y, convert=lambda y: y):
+            # crop to the time range, then convert only the values left over
+            if t_range is not None:
+                start = np.searchsorted(t_bin, t_lo, side='right') - 1 # last change before the range
+                end = np.searchsorted(t_bin, t_hi, side='right')
+                if start >= 0:
+                    return t_bin[start:end] /fpga_clk_freq_MHz - self._initial_wait, convert(y[start:end])
+                t_bin, y = t_bin[:end], y[:end]
             # add a zero event in the beginning, and shift the times to the 'user frame'
             t = np.concatenate( ([0], t_bin) ) /fpga_clk_freq_MHz - self._initial_wait
             # add a zero value in the beginning of outputs
-            y2 = np.concatenate( ([0], y) )
+            y2 = np.concatenate( ([0], convert(y)) )
             return t, y2
 
         # Convert TX channels
         for txl in ['tx0_i', 'tx0_q', 'tx1_i', 'tx1_q']:
+            if not wanted(txl):
+                continue
             try:
                 t_bin, tx_bin = intd[txl]
-                t, tx = convert_t(t_bin, tx_bin.astype(np.int16) / 32768)
+                t, tx = convert_t(t_bin, tx_bin, lambda y: y.astype(np.int16) / 32768)
                 flodict[txl] = (t, tx)
             except KeyError:
                 continue
 
         # Convert gradient channels
         for gradl in self.gradb.keys():
+            if not wanted(gradl):
+                continue
             try:
                 t_bin, grad_bin = intd[gradl]
-                t, grad = convert_t(t_bin, self.gradb.bin2float(grad_bin) )
+                t, grad = convert_t(t_bin, grad_bin, self.gradb.bin2float)
                 flodict[gradl] = (t, grad)
             except KeyError:
                 continue
 
         # Convert RX enable channels
         for rxl in ['rx0_en', 'rx1_en', 'rx2_en', 'rx3_en']:
+            if not wanted(rxl):
+                continue
             try:
                 t_bin, rx = intd[rxl]
                 t, rx = convert_t(t_bin, rx)
@@ -393,6 +864,8 @@ class Experiment:
 
         # Convert digital outputs
         for iol in ['tx_gate', 'rx_gate', 'trig_out', 'leds']:
+            if not wanted(iol):
+                continue
             try:
                 t_bin, io = intd[iol]
                 t, io = convert_t(t_bin, io)
@@ -404,47 +877,53 @@ class Experiment:
 
         return flodict
 
-    def plot_sequence(self, axes=None):
+    def plot_sequence(self, axes=None, keys=None, t_range=None, max_points=4000):
         """ axes: 4-element tuple of axes upon which the TX, gradients, RX and digital I/O plots will be drawn.
-        If not provided, plot_sequence() will create its own. """
+        If not provided, plot_sequence() will create its own.
+
+        keys, t_range: only plot these keys and this time range, see get_flodict()
+        max_points: reduce each trace to about this many points, keeping the
+        minimum and maximum values within each of max_points/4 time bins (see
+        envelope()); None to plot every point """
         if axes is None:
             _, axes = plt.subplots(4, 1, figsize=(12,8), sharex='col')
 
         (txs, grads, rxs, ios) = axes
 
-        fd = self.get_flodict()
+        fd = self.get_flodict(keys=keys, t_range=t_range)
 
-        # Plot TX channels
-        for txl in ['tx0_i', 'tx0_q', 'tx1_i', 'tx1_q']:
+        def step(ax, label):
             try:
-                txs.step(*fd[txl], where='post', label=txl)
+                t, y = fd[label]
             except KeyError:
-                continue
+                return
+            if max_points is not None and t.size > max_points:
+                idces = envelope(t, y, max_points // 4)
+                t, y = t[idces], y[idces]
+            ax.step(t, y, where='post', label=label)
+
+        # Plot TX channels
+        for txl in ['tx0_i', 'tx0_q', 'tx1_i', 'tx1_q']:
+            step(txs, txl)
 
         # Plot gradient channels
         for gradl in self.gradb.keys():
-            try:
-                grads.step(*fd[gradl], where='post', label=gradl)
-            except KeyError:
-                continue
+            step(grads, gradl)
 
         # Plot RX enable channels
         for rxl in ['rx0_en', 'rx1_en', 'rx2_en', 'rx3_en']:
-            try:
-                rxs.step(*fd[rxl], where='post', label=rxl)
-            except KeyError:
-                continue
+            step(rxs, rxl)
 
         # Plot digital outputs
         for iol in ['tx_gate', 'rx_gate', 'trig_out', 'leds']:
-            try:
-                ios.step(*fd[iol], where='post', label=iol)
-            except KeyError:
-                continue
+            step(ios, iol)
 
         for ax in axes:
-            ax.legend()
+            if ax.get_legend_handles_labels()[0]:
+                ax.legend()
             ax.grid(True)
+            if t_range is not None:
+                ax.set_xlim(t_range)
 
         ios.set_xlabel(r'time ($\mu$s)')
         return fd
@@ -457,47 +936,320 @@ class Experiment:
             self.compile()
 
         if self._flush_old_rx:
-            rx_data_old, _ = sc.command({'read_rx': 0}, self._s)
+            rx_data_old, _ = self._plain_command({'read_rx': 0})
             # TODO: do something with RX data previously collected by the server
 
-        rx_data, msgs = sc.command({'run_seq': self._machine_code.tobytes()}, self._s)
+        # upload, execution and RX download are a single round trip
+        t0 = time.perf_counter()
+        rx_data, msgs = self._plain_command({'run_seq': self._machine_code.tobytes()})
+        self._time_phase('run_seq', t0)
+        return self._finish_run(rx_data, msgs)
+
+    async def run_async(self, timeout=None):
+        """ asyncio version of run(), over the async_connection given to
+        the constructor. Any deferred server initialisation, compilation
+        and RX decoding are done in worker threads, so other tasks in the
+        event loop keep running meanwhile.
+
+        timeout: seconds to wait for the sequence to run and its RX data
+        to arrive; the connection is closed if it runs out """
+        assert self._aconn is not None, "run_async() needs an async_connection"
+        if self._server_init_pending:
+            await asyncio.to_thread(self._init_pending_server)
+
+        if not self._seq_compiled:
+            await asyncio.to_thread(self.compile)
+
+        if self._flush_old_rx:
+            rx_data_old, _ = await self._aconn.command({'read_rx': 0}, stats=self._timing, timeout=timeout)
+
+        t0 = time.perf_counter()
+        rx_data, msgs = await self._aconn.command({'run_seq': self._machine_code.tobytes()}, stats=self._timing, timeout=timeout)
+        self._time_phase('run_seq', t0)
+        return await asyncio.to_thread(self._finish_run, rx_data, msgs)
+
+    async def gradb_async(self, method, *args, **kwargs):
+        """ Call a gradient board method which sends server commands, such
+        as self.gradb.init_hw or self.gradb.write_dac, in a worker thread
+        so that the event loop isn't blocked; needs an async_connection """
+        assert self._aconn is not None, "gradb_async() needs an async_connection"
+        return await asyncio.to_thread(method, *args, **kwargs)
+
+    def run_many(self, sequences, prefetch=2, tolerances=None):
+        """Run many floating-point dictionaries one after another, e.g. the
+        steps of a sweep. Upcoming sequences are compiled in a background
+        thread, and each one is sent from another thread as soon as the
+        previous one has finished, while the RX data are decoded here; so
+        the hardware is kept busy as long as the caller keeps up.
+
+        sequences: iterable of floating-point dictionaries; each one replaces the values of the keys it contains, as for add_flodict(append=False)
+        prefetch: maximum number of sequences compiled ahead, and of runs waiting to be decoded, to bound the memory used
+        tolerances: optional lossy decimation of each sequence, see flo2int()
+
+        Yields (rxd_iq, msgs) for each sequence, as returned by run().
+        Nothing else should be done with the Experiment until the generator
+        is exhausted or closed."""
+        assert prefetch >= 1, "prefetch must be at least 1"
+        compiled, finished = queue.Queue(prefetch), queue.Queue(prefetch)
+        stop = threading.Event() # set when the generator is closed
+
+        def put(q, item):
+            while not stop.is_set():
+                try:
+                    q.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def get(q):
+            while not stop.is_set():
+                try:
+                    return q.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            return None
+
+        def compile_all():
+            try:
+                for flodict in sequences:
+                    if stop.is_set():
+                        return
+                    self.add_flodict(flodict, append=False, tolerances=tolerances)
+                    if not self._seq_compiled:
+                        self.compile()
+                    # the timing record goes along with the sequence; copy the machine code, since templates are patched in place
+                    record = self._timing
+                    if record is not None:
+                        self._timing = {}
+                    if not put(compiled, (np.array(self._machine_code), record)):
+                        return
+            except BaseException as e:
+                put(compiled, e)
+                return
+            put(compiled, None)
+
+        def run_all():
+            while True:
+                item = get(compiled)
+                if item is None or isinstance(item, BaseException):
+                    put(finished, item)
+                    return
+                machine_code, record = item
+                try:
+                    if self._flush_old_rx:
+                        rx_data_old, _ = self._plain_command({'read_rx': 0}, record)
+                    t0 = time.perf_counter()
+                    rx_data, msgs = self._plain_command({'run_seq': machine_code.tobytes()}, record)
+                    self._time_phase('run_seq', t0, record)
+                except BaseException as e:
+                    put(finished, e)
+                    return
+                if not put(finished, (rx_data, msgs, record, machine_code.size)):
+                    return
+
+        threads = [threading.Thread(target=f, daemon=True) for f in (compile_all, run_all)]
+        for th in threads:
+            th.start()
+        try:
+            while True:
+                try:
+                    item = finished.get(timeout=0.1)
+                except queue.Empty:
+                    # the run thread always ends by queueing None or an exception, unless it was killed
+                    assert threads[1].is_alive() or not finished.empty(), "The run_many() thread stopped unexpectedly"
+                    continue
+                if item is None:
+                    return
+                if isinstance(item, BaseException):
+                    raise item
+                yield self._finish_run(*item)
+        finally:
+            # wait for any sequence still running, so that its reply isn't left on the socket
+            stop.set()
+            for th in threads:
+                th.join()
+
+    def _finish_run(self, rx_data, msgs, record=None, instructions=None):
+        """ Decode the RX data from a run_seq reply, and finish the run's
+        timing record (the current one, unless record is given) """
+        t0 = time.perf_counter()
 
         rxd = rx_data[4]['run_seq']
         rxd_iq = {}
 
         # (1 << 24) just for the int->float conversion to be reasonable - exact value doesn't matter for now
         rx0_norm_factor = self._rx0_cic_factor / (1 << 24)
-        rx1_norm_factor = self._rx0_cic_factor / (1 << 24)
-
-        try:
-            rxd_iq['rx0'] = rx0_norm_factor * ( np.array(rxd['rx0_i']).astype(np.int32).astype(float) + \
-                             1j * np.array(rxd['rx0_q']).astype(np.int32).astype(float) )
-        except (KeyError, TypeError):
-            pass
-
-        try:
-            rxd_iq['rx1'] = rx1_norm_factor * ( np.array(rxd['rx1_i']).astype(np.int32).astype(float) + \
-                             1j * np.array(rxd['rx1_q']).astype(np.int32).astype(float) )
-        except (KeyError, TypeError):
-            pass
+        rx1_norm_factor = self._rx1_cic_factor / (1 << 24)
 
-        try:
-            rxd_iq['rx2'] = rx0_norm_factor * ( np.array(rxd['rx2_i']).astype(np.int32).astype(float) + \
-                             1j * np.array(rxd['rx2_q']).astype(np.int32).astype(float) )
-        except (KeyError, TypeError):
-            pass
+        if self._rx_sink is not None:
+            # decode straight into the sink's files; the returned arrays are memory-mapped
+            self._rx_sink.begin_run(rx_t=self.get_rx_ts(), lo_freq=self._lo_freqs,
+                                    cic_factor=(self._rx0_cic_factor, self._rx1_cic_factor))
 
         try:
-            rxd_iq['rx3'] = rx1_norm_factor * ( np.array(rxd['rx3_i']).astype(np.int32).astype(float) + \
-                             1j * np.array(rxd['rx3_q']).astype(np.int32).astype(float) )
-        except (KeyError, TypeError):
-            pass
+            # RX channels 2 and 3 run at the same rates as 0 and 1
+            for ch, norm_factor in zip(['rx0', 'rx1', 'rx2', 'rx3'], [rx0_norm_factor, rx1_norm_factor, rx0_norm_factor, rx1_norm_factor]):
+                alloc = None if self._rx_sink is None else (lambda n, ch=ch: self._rx_sink.reserve(ch, n))
+                try:
+                    rxd_iq[ch] = decode_rx(rxd[ch + '_i'], rxd[ch + '_q'], norm_factor, self._rx_dtype, alloc)
+                except (KeyError, TypeError):
+                    pass
+        except BaseException:
+            if self._rx_sink is not None:
+                self._rx_sink.abort_run() # don't record a partly-written run
+            raise
+
+        if self._rx_sink is not None:
+            self._rx_sink.end_run()
+        self._time_phase('rx_decode', t0, record)
+
+        if record is None and self._timing is not None:
+            # finish this run's record, and start a new one for the next run
+            record, self._timing = self._timing, {}
+        if record is not None:
+            if instructions is None:
+                instructions = self._machine_code.size
+            record.update(instructions=instructions, rx_samples=sum(rx.size for rx in rxd_iq.values()))
+            self.last_run_stats = record
+            if self._timing_callback is not None:
+                self._timing_callback(record)
         return rxd_iq, msgs
 
     def close_server(self, only_if_sim=False):
         ## Either always close server, or only close server if it's a simulation
-        if not only_if_sim or sc.command({'are_you_real':0}, self._s)[0][4]['are_you_real'] == "simulation":
-            sc.send_packet(sc.construct_packet({}, 0, command=sc.close_server_pkt), self._s)
+        if not only_if_sim or self._plain_command({'are_you_real':0})[0][4]['are_you_real'] == "simulation":
+            if self._aconn is not None:
+                self._aconn.sync_close_server()
+            else:
+                sc.send_packet(sc.construct_packet({}, 0, command=sc.close_server_pkt), self._socket())
+
+class SessionGradb:
+    """A session's gradient board, as used by one of its Experiments:
+    its methods send their commands through the Experiment (with its
+    print_infos, assert_errors and timing settings), while its state,
+    such as the calibration, is shared with the session's board"""
+
+    def __init__(self, gradb, server_command_f, server_command_batch_f):
+        vars(self).update(_gradb=gradb, server_command=server_command_f, server_command_batch=server_command_batch_f)
+
+    def __getattr__(self, name):
+        attr = getattr(type(self._gradb), name, None)
+        if callable(attr):
+            return types.MethodType(attr, self) # so that it calls self.server_command
+        return getattr(self._gradb, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._gradb, name, value)
+
+class Session:
+    """Server connection, gradient board and hardware state shared by
+    many Experiments, e.g. the points of a sweep, so that connecting and
+    initialising the GPA only happen once:
+
+        session = Session()
+        for amp in amps:
+            expt = session.experiment()
+            expt.add_flodict(...)
+            expt.run()
+
+    Experiments made by experiment() use the session's socket and
+    gradient board (including its calibration), initialise the GPA and
+    halt_and_reset only the first time they're requested, and default
+    to the LO and RX settings of the previous experiment. The socket is
+    connected when it's first needed.
+
+    prev_socket: previously-opened socket to use, rather than connecting to the server
+    """
+
+    def __init__(self, prev_socket=None, grad_max_update_rate=0.2, print_infos=True, assert_errors=True):
+        self._s = prev_socket
+        self._close_socket = prev_socket is None
+        self._print_infos = print_infos
+        self._assert_errors = assert_errors
+
+        assert grad_board in gradb_classes, "Unknown gradient board!"
+        self.grad_max_update_rate = grad_max_update_rate
+        self.gradb = gradb_classes[grad_board](self.server_command, grad_max_update_rate, self.server_command_batch)
+        self.gpa_initialised = False
+        self.halted = False
+        self._settings = {} # LO and RX settings of the last experiment
+
+    def __del__(self):
+        self.close()
+
+    def socket(self):
+        """ Socket to the server, connected on first use """
+        if self._s is None:
+            self._s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self._s.connect( (ip_address, port) )
+        return self._s
+
+    def server_command(self, server_dict):
+        return sc.command(server_dict, self.socket(), self._print_infos, self._assert_errors)
+
+    def server_command_batch(self, server_dicts):
+        return sc.command_batch(server_dicts, self.socket(), self._print_infos, self._assert_errors)
+
+    def experiment(self, **kwargs):
+        """ New Experiment using this session; takes the same arguments as
+        Experiment, except that grad_max_update_rate must match the session's """
+        for k in ('lo_freq', 'rx_t', 'rx_lo'):
+            if k in kwargs:
+                self._settings[k] = kwargs[k]
+        kwargs = {'print_infos': self._print_infos, 'assert_errors': self._assert_errors, **self._settings, **kwargs}
+        return Experiment(session=self, **kwargs)
+
+    def close(self):
+        if self._close_socket and self._s is not None:
+            self._s.close()
+            self._s = None
+
+## Batch compilation in a process pool; each worker process keeps an
+## offline Experiment, so keys which are the same as in the worker's
+## previous sequence don't need to be recompiled
+
+# grad board attributes which affect compilation, copied to the workers' grad boards
+gradb_cal_attrs = ('cal_values', 'gpaCal', 'spi_div', 'bin_config')
+
+_batch_expt = None
+_batch_keys = set() # keys of the worker's previous sequence
+
+def _batch_init(expt_kwargs, gradb_cal):
+    global _batch_expt
+    _batch_expt = Experiment(offline=True, **expt_kwargs)
+    vars(_batch_expt.gradb).update(gradb_cal)
+
+def _batch_compile(flodict):
+    global _batch_keys
+    intdict = _batch_expt.flo2int(flodict)
+    if _batch_expt._seq is not None:
+        _batch_expt._join_seq_chunks()
+        for k in _batch_keys - set(intdict):
+            _batch_expt._seq.pop(k, None) # left over from the previous sequence; compile() adds back any initial configuration
+    _batch_keys = set(intdict)
+    _batch_expt.add_intdict(intdict, append=False)
+    _batch_expt.compile()
+    return np.array(_batch_expt._machine_code)
+
+def compile_batch(flodicts, processes=None, chunksize=1, gradb=None, **expt_kwargs):
+    """Compile many floating-point sequence dictionaries which share the
+    same Experiment settings across a pool of processes, e.g. for a
+    parameter sweep.
+
+    flodicts: iterable of floating-point dictionaries
+    processes: number of worker processes; os.cpu_count() by default
+    gradb: grad board whose calibration the workers should use, e.g. expt.gradb of the Experiment which will run the sequences
+    expt_kwargs: settings passed to the Experiment in each worker, such as lo_freq and rx_t
+
+    Returns a list of the machine code arrays, in the order of flodicts,
+    to be run with Experiment.load_compiled() by an Experiment with the same settings"""
+    assert not {'seq_dict', 'seq_csv', 'prev_socket', 'session', 'async_connection'} & expt_kwargs.keys(), \
+        "The sequences must be given in flodicts, and the workers can't share a connection"
+    expt_kwargs.setdefault('print_infos', False)
+    gradb_cal = {} if gradb is None else {k: getattr(gradb, k) for k in gradb_cal_attrs if hasattr(gradb, k)}
+    with mp.Pool(processes, initializer=_batch_init, initargs=(expt_kwargs, gradb_cal)) as pool:
+        return pool.map(_batch_compile, flodicts, chunksize)
 
 def test_rx_scaling(lo_freq=0.5, rf_amp=0.5, rf_steps=True, rx_time=50, rx_periods=[600], rx_padding=20, plot_rx=False):
 
@@ -49,10 +49,38 @@ st = pdb.set_trace
 
 grad_clk_t = 1/lc.fpga_clk_freq_MHz # ~8.14ns period for RP-122
 
+def send_init_words(gradb, init_words, busy_mask, wait_for_idle):
+    """Send words to the GPA serialiser with direct commands, MSBs then
+    LSBs, once the interface core is idle (busy_mask bit of marga
+    register 5 clear).
+
+    If the grad board has a server_command_batch function, all the
+    commands are pipelined, with three register reads before each word
+    in place of wait_for_idle(). If the core turns out to have been busy
+    before a word, the previous word may have been cut short as well, so
+    from the previous word onwards they're all sent again one at a time,
+    waiting properly."""
+    start = 0
+    if gradb.server_command_batch is not None:
+        cmds = []
+        for iw in init_words:
+            cmds += [{'regrd': 5}] * 3 + [{'direct': 0x02000000 | (iw >> 16)}, {'direct': 0x01000000 | (iw & 0xffff)}]
+        replies = gradb.server_command_batch(cmds)
+        busy = [rd[4]['regrd'] & busy_mask for rd, _ in replies[2::5]]
+        start = next((max(k - 1, 0) for k, b in enumerate(busy) if b), len(init_words))
+
+    for iw in init_words[start:]:
+        wait_for_idle()
+
+        # direct commands to grad board; send MSBs then LSBs
+        gradb.server_command({'direct': 0x02000000 | (iw >> 16)})
+        gradb.server_command({'direct': 0x01000000 | (iw & 0xffff)})
+
 class OCRA1:
     def __init__(self,
                  server_command_f,
-                 max_update_rate=0.1):
+                 max_update_rate=0.1,
+                 server_command_batch_f=None):
         """ max_update_rate is in MSPS for updates on a single channel; used to choose the SPI clock divider """
 
         spi_cycles_per_tx = 30 # actually 24, but including some overhead
@@ -62,6 +90,7 @@ class OCRA1:
 
         # bind function from Experiment class, or replace with something else for debugging
         self.server_command = server_command_f
+        self.server_command_batch = server_command_batch_f # optional, sends a list of commands in a few round trips
 
         # Default calibration settings for all channels: linear transformation for now
         self.cal_values = [ (1,0), (1,0), (1,0), (1,0) ]
@@ -119,12 +148,7 @@ class OCRA1:
         self.server_command({'direct': 0x00000000 | (1 << 0) | (self.spi_div << 2) | (0 << 8) | (0 << 9)})
         self.server_command({'direct': 0x00000000 | (1 << 0) | (self.spi_div << 2) | (1 << 8) | (0 << 9)})
 
-        for k, iw in enumerate(init_words):
-            self.wait_for_ocra1_iface_idle()
-
-            # direct commands to grad board; send MSBs then LSBs
-            self.server_command({'direct': 0x02000000 | (iw >> 16)})
-            self.server_command({'direct': 0x01000000 | (iw & 0xffff)})
+        send_init_words(self, init_words, 0x10000, self.wait_for_ocra1_iface_idle)
 
         # restore main grad ctrl word to its default value, and reset the OCRA1 iface core
         self.server_command({'direct': 0x00000000})
@@ -158,7 +182,8 @@ class OCRA1:
         return "ocra1_" + vstr, ch_list.index(vstr)
 
     def float2bin(self, grad_data, channel=0):
-        cv = self.cal_values[channel]
+        # channel: single channel, or array of channels for each value
+        cv = np.moveaxis(np.asarray(self.cal_values)[channel], -1, 0)
         gd_cal = grad_data * cv[0] + cv[1] # calibration
         return np.round(131071.49 * gd_cal).astype(np.uint32) & 0x3ffff # 2's complement
 
@@ -168,7 +193,8 @@ class OCRA1:
 class OCRA40:
     def __init__(self,
                  server_command_f,
-                 max_update_rate=0.1):
+                 max_update_rate=0.1,
+                 server_command_batch_f=None):
         """ max_update_rate is in MSPS for updates on a single channel; used to choose the SPI clock divider """
 
         spi_cycles_per_tx = 30 # actually 24, but including some overhead
@@ -178,6 +204,7 @@ class OCRA40:
 
         # bind function from Experiment class, or replace with something else for debugging
         self.server_command = server_command_f
+        self.server_command_batch = server_command_batch_f # optional, sends a list of commands in a few round trips
 
         # Default calibration settings for all channels: linear transformation for now
         self.cal_values = [ (1,0) ] * 40
@@ -264,12 +291,7 @@ class OCRA40:
         self.server_command({'direct': 0x00000000 | (1 << 0) | (self.spi_div << 2) | (0 << 8) | (0 << 9)})
         self.server_command({'direct': 0x00000000 | (1 << 0) | (self.spi_div << 2) | (1 << 8) | (0 << 9)})
 
-        for k, iw in enumerate(init_words):
-            self.wait_for_ocra40_iface_idle()
-
-            # direct commands to grad board; send MSBs then LSBs
-            self.server_command({'direct': 0x02000000 | (iw >> 16)})
-            self.server_command({'direct': 0x01000000 | (iw & 0xffff)})
+        send_init_words(self, init_words, 0x10000, self.wait_for_ocra40_iface_idle)
 
         # restore main grad ctrl word to its default value, and reset the OCRA40 iface core
         self.server_command({'direct': 0x00000000})
@@ -303,7 +325,8 @@ class OCRA40:
         return "ocra40_" + vstr, ch_list.index(vstr)
     
     def float2bin(self, grad_data, channel=0):
-        cv = self.cal_values[channel]
+        # channel: single channel, or array of channels for each value
+        cv = np.moveaxis(np.asarray(self.cal_values)[channel], -1, 0)
         gd_cal = grad_data * cv[0] + cv[1]
         return np.round(131071.49 * gd_cal).astype(np.uint32) & 0x3ffff # 2's complement
     
@@ -313,7 +336,8 @@ class OCRA40:
 class GPAFHDO:
     def __init__(self,
                  server_command_f,
-                 max_update_rate=0.1):
+                 max_update_rate=0.1,
+                 server_command_batch_f=None):
         """ max_update_rate is in MSPS for updates on a single channel; used to choose the SPI clock divider """
         fhdo_max_update_rate = max_update_rate * 4 # single-channel serial, so needs to be faster
 
@@ -326,6 +350,7 @@ class GPAFHDO:
 
         # bind function from Experiment class, or replace with something else for debugging
         self.server_command = server_command_f
+        self.server_command_batch = server_command_batch_f # optional, sends a list of commands in a few round trips
 
         # TODO: will this ever need modification?
         self.grad_channels = 4
@@ -398,12 +423,7 @@ class GPAFHDO:
 
         self.server_command({'direct': 0x00000000 | (2 << 0) | (self.adc_spi_div << 2) | (0 << 8) | (0 << 9)})
 
-        for iw in init_words:
-            self.wait_for_gpa_fhdo_iface_idle()
-
-            # direct commands to grad board; send MSBs then LSBs
-            self.server_command({'direct': 0x02000000 | (iw >> 16)})
-            self.server_command({'direct': 0x01000000 | (iw & 0xffff)})
+        send_init_words(self, init_words, 0x20000, self.wait_for_gpa_fhdo_iface_idle)
 
         # restore main grad ctrl word to default
         self.server_command({'direct': 0x00000000})
@@ -633,14 +653,20 @@ class GPAFHDO:
 
     def float2bin(self, grad_vals, channel=0, cal=False):
         # cal: apply calibration or not
+        # channel: single channel, or array of channels for each value
         # Not 2's complement - 0x0 word is ~0V (-10A), 0xffff is ~+5V (+10A)
         # gr_dacbits_cal = self.calculate_corrected_dac_code(channel,gr_dacbits)
-        if cal:
+        if cal and np.ndim(channel):
+            chans = np.broadcast_to(channel, np.shape(grad_vals))
+            grad_vals_cal = np.empty(np.shape(grad_vals))
+            for ch in np.unique(chans):
+                grad_vals_cal[chans == ch] = self.apply_cal(grad_vals[chans == ch], ch)
+        elif cal:
             grad_vals_cal = self.apply_cal(grad_vals, channel)
         else:
             grad_vals_cal = grad_vals
         gr_dacbits = np.round(32767.51 * (grad_vals_cal + 1)).astype(np.uint16)
-        gr = gr_dacbits | 0x80000 | (channel << 16)
+        gr = gr_dacbits.astype(np.uint32) | 0x80000 | (channel << 16)
 
         # # always broadcast for the final channel (TODO: probably not needed for GPA-FHDO, check then remove)
         # broadcast = channel == self.grad_channels - 1
@@ -649,3 +675,29 @@ class GPAFHDO:
 
     def bin2float(self, grad_bin):
         return (grad_bin & 0xffff).astype(np.uint16) / 32768 - 1
+
+def test_init_resend(busy_word=10):
+    """ Check that OCRA40 init words are sent again from the word before
+    the first one found busy, using a local mock server """
+    import socket
+    import mock_server
+    import server_comms as sc
+    server = mock_server.start()
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.connect(server.server_address)
+    try:
+        gradb = OCRA40(lambda d: sc.command(d, s), 0.2, lambda ds: sc.command_batch(ds, s))
+        server.set_busy(4, after=3 * busy_word + 2) # the last read before busy_word, and the next three
+        gradb.init_hw()
+        # after the grad ctrl words, all the init words are pipelined, then some are sent again
+        words = [(msb & 0xffff) << 16 | (lsb & 0xffff) for msb, lsb in zip(server.directs[2:-1:2], server.directs[3:-1:2])]
+        first_resent = max(busy_word - 1, 0)
+        n_words = (len(words) + first_resent) // 2
+        assert words[n_words:] == words[first_resent:n_words], "Words from the one before the busy read onwards were not sent again"
+        print("Resent {:d} of {:d} init words".format(len(words) - n_words, n_words))
+    finally:
+        s.close()
+        server.shutdown()
+
+if __name__ == "__main__":
+    test_init_resend()
@@ -19,6 +19,12 @@ grad_board = "ocra40"
 ## GPA-FHDO current per volt setting (determined by resistors)
 gpa_fhdo_current_per_volt = 2.5
 
+## Compiled program cache (optional): directory to store compiled
+## sequences in, so that they don't need to be recompiled in later
+## sessions, and its maximum size. Uncomment the lines below to enable.
+#compile_cache_dir = "/tmp/marga_cache"
+#compile_cache_max_MB = 1024
+
 ## Flocra-pulseq path, for use of the flocra-pulseq library (optional).
 ## Uncomment the lines below and adjust the path to suit your
 ## flocra-pulseq location.
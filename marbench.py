@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+# Benchmarks for the marcompile pipeline
+#
+# Times each stage of compilation (Experiment.flo2int,
+# marcompile.dict2bin, cl2bin and csv2bin) separately on synthetic
+# workloads of increasing size, reporting events per second and peak
+# memory, and compares the results against a stored baseline.
+#
+# Usage: python marbench.py [--sizes 1e3 1e4 ...] [--workloads ...] [--save-baseline]
+#
+# The first run (or any run with --save-baseline) stores its results as
+# the baseline; later runs fail if any stage has become more than
+# --tolerance times slower than the baseline.
+
+import argparse, json, os, sys, tempfile, time, tracemalloc, warnings
+import numpy as np
+
+import experiment as ex
+import grad_board as gb
+import marcompile as fc
+
+default_baseline = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench_baseline.json')
+
+## Workloads: each returns a floating-point sequence dictionary with about n events, and the grad board to use
+
+def triangle(peak, n_points, sample_rate):
+    """ Triangle pulse with n_points samples, as in the readme notebook """
+    x = 1e6 * np.arange(n_points) / sample_rate
+    lhs = np.linspace(0, peak, n_points // 2)
+    rhs = np.linspace(peak, 0, n_points - n_points // 2)
+    return x, np.hstack((lhs, rhs))
+
+def ocra40_triangles(n):
+    """ Triangle pulses on all 40 OCRA40 channels """
+    m = max(n // 40, 2)
+    return {f'ocra40_v{ch}': triangle(0.1 + 0.002 * ch, m, 10000) for ch in range(40)}, 'ocra40'
+
+def tx_dense(n):
+    """ Dense complex TX waveform, 1 us per sample """
+    m = max(n // 2, 2)
+    t = np.arange(m) * 1.0
+    return {'tx0': (t, 0.5 * np.exp(2j * np.pi * t / 37.3) * np.linspace(0.2, 1, m))}, 'ocra40'
+
+def fhdo_ramps(n):
+    """ Ramps on the 4 GPA-FHDO channels, offset in time from each other """
+    m = max(n // 4, 2)
+    t = np.arange(m) * 20.0
+    ramp = np.tile(np.linspace(-0.5, 0.5, 50), m // 50 + 1)[:m]
+    return {key: (t + 5 * ch, ramp * (ch + 1) / 4) for ch, key in enumerate(['fhdo_vx', 'fhdo_vy', 'fhdo_vz', 'fhdo_vz2'])}, 'gpa-fhdo'
+
+def rx_windows(n):
+    """ Many short RX windows with TX and RX gates """
+    m = max(n // 8, 1)
+    starts = np.arange(m) * 20.0
+    on_off = lambda t0, t1: ( np.stack([starts + t0, starts + t1], axis=1).reshape(-1), np.tile([1, 0], m) )
+    return {'tx_gate': on_off(1, 3), 'rx_gate': on_off(4, 15),
+            'rx0_en': on_off(5, 15), 'rx1_en': on_off(5, 15)}, 'ocra40'
+
+workloads = {'ocra40_triangles': ocra40_triangles,
+             'tx_dense': tx_dense,
+             'fhdo_ramps': fhdo_ramps,
+             'rx_windows': rx_windows}
+
+## Helpers
+
+def make_experiment(board):
+    """ Experiment for compiling only; it never connects to the server """
+    expt = ex.Experiment(offline=True, print_infos=False)
+    if board == 'gpa-fhdo':
+        expt.gradb = gb.GPAFHDO(expt.server_command, 0.2)
+    else:
+        expt.gradb = gb.OCRA40(expt.server_command, 0.2)
+    return expt
+
+def dict2npy(sd, path):
+    """ Write an integer sequence dictionary out as the binary
+    equivalent of a CSV execution file, for csv2bin() """
+    times = np.unique(np.concatenate([t for t, v in sd.values()]))
+    data = np.zeros((times.size, len(fc.col_arr) + 1), dtype=np.uint32) # extra column for the CSV version
+    data[:, 0] = times
+    for k, (t, v) in sd.items():
+        # hold each value until it next changes
+        order = np.argsort(t, kind='stable')
+        idx = np.searchsorted(t[order], times, side='right') - 1
+        data[:, fc.col_idx_table[k]] = np.where(idx >= 0, v[order][np.maximum(idx, 0)], 0)
+    np.save(path, data)
+
+def measure(f, min_time=0.2):
+    """ Best time for running f(), repeated until at least min_time has
+    passed, then the peak memory allocated during one more run """
+    best, total = np.inf, 0
+    while total < min_time:
+        t0 = time.perf_counter()
+        f()
+        dt = time.perf_counter() - t0
+        best, total = min(best, dt), total + dt
+
+    tracemalloc.start()
+    f()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return best, peak
+
+def bench_workload(name, n, tmpdir):
+    flodict, board = workloads[name](n)
+    expt = make_experiment(board)
+    old_board, fc.grad_board = fc.grad_board, board # marcompile normally takes this from local_config.py
+    try:
+        initial_bufs, latencies = expt.gradb.bin_config['initial_bufs'], expt.gradb.bin_config['latencies']
+
+        intdict = expt.flo2int(flodict)
+        events = sum(t.size for t, v in intdict.values())
+        changelists = fc.dict2cl(intdict, latencies)
+        npy_path = os.path.join(tmpdir, name + '.npy')
+        dict2npy(intdict, npy_path)
+
+        stages = {'flo2int': lambda: expt.flo2int(flodict),
+                  'dict2bin': lambda: fc.dict2bin(intdict, initial_bufs, latencies),
+                  'cl2bin': lambda: fc.cl2bin(*changelists, initial_bufs),
+                  'csv2bin': lambda: fc.csv2bin(npy_path, False, initial_bufs, latencies)}
+        results = {}
+        for stage, f in stages.items():
+            dt, peak = measure(f)
+            results[stage] = {'events': events, 'time': dt, 'events_per_s': events / dt, 'peak_MB': peak / 1e6}
+    finally:
+        fc.grad_board = old_board
+    return results
+
+def compare(results, baseline, tolerance):
+    """ List the stages which have got slower than the baseline by more than tolerance """
+    regressions = []
+    for name, sizes in results.items():
+        for size, stages in sizes.items():
+            for stage, r in stages.items():
+                try:
+                    base = baseline[name][size][stage]['events_per_s']
+                except KeyError:
+                    continue # not benchmarked before
+                if r['events_per_s'] * tolerance < base:
+                    regressions.append("{:s} n={:s} {:s}: {:.3g} events/s, baseline {:.3g} events/s".format(
+                        name, size, stage, r['events_per_s'], base))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the marcompile pipeline")
+    parser.add_argument('--sizes', type=float, nargs='+', default=[1e3, 1e4, 1e5, 1e6, 1e7], help="approximate numbers of events")
+    parser.add_argument('--workloads', nargs='+', default=list(workloads), choices=list(workloads))
+    parser.add_argument('--baseline', default=default_baseline, help="baseline results file")
+    parser.add_argument('--save-baseline', action='store_true', help="store these results as the new baseline")
+    parser.add_argument('--tolerance', type=float, default=1.5, help="slowdown factor relative to the baseline counted as a regression")
+    args = parser.parse_args()
+
+    warnings.simplefilter('ignore') # compiler warnings are expected for some workloads
+    results = {}
+    print("{:>18s} {:>9s} {:>9s} {:>10s} {:>13s} {:>10s}".format('workload', 'size', 'stage', 'time [s]', 'events/s', 'peak [MB]'))
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for name in args.workloads:
+            results[name] = {}
+            for n in args.sizes:
+                size = '{:.0e}'.format(n)
+                results[name][size] = bench_workload(name, int(n), tmpdir)
+                for stage, r in results[name][size].items():
+                    print("{:>18s} {:>9s} {:>9s} {:>10.4f} {:>13.4g} {:>10.1f}".format(
+                        name, size, stage, r['time'], r['events_per_s'], r['peak_MB']))
+                sys.stdout.flush()
+
+    if args.save_baseline or not os.path.exists(args.baseline):
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=1)
+        print("Saved baseline to " + args.baseline)
+        return
+
+    with open(args.baseline) as f:
+        regressions = compare(results, json.load(f), args.tolerance)
+    if regressions:
+        sys.exit("PERFORMANCE REGRESSIONS:\n" + "\n".join(regressions))
+    print("No regressions relative to " + args.baseline)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+# Content-addressed on-disk cache of compiled marga machine code
+#
+# Programs are stored as .npy files named after a hash of everything
+# the compilation depends on, so a sequence which has already been
+# compiled (in this or any earlier Python process) is simply
+# memory-mapped from disk. The least recently used files are deleted
+# once the cache grows past its size limit.
+
+import hashlib, os
+import numpy as np
+import marcompile as fc
+
+# Part of every cache key; bump it whenever the compiler's output changes
+# for the same input, so that programs compiled before aren't served
+CACHE_VERSION = 1
+
+## Optional settings in local_config.py; the cache is disabled for the
+## Experiment class unless compile_cache_dir is set
+try:
+    from local_config import compile_cache_dir
+except ImportError:
+    compile_cache_dir = None
+try:
+    from local_config import compile_cache_max_MB
+except ImportError:
+    compile_cache_max_MB = 1024
+
+def _cache_dir(cache_dir):
+    cache_dir = cache_dir or compile_cache_dir
+    assert cache_dir is not None, "No compile cache directory given, and compile_cache_dir is not set in local_config.py"
+    return cache_dir
+
+def _hasher(initial_bufs, latencies):
+    """Start a hash with the settings which affect every compilation.
+    The grad board is read from marcompile each time, since it can be
+    changed at runtime; the clock frequency doesn't matter, since the
+    sequences are already in clock cycles."""
+    h = hashlib.sha256()
+    h.update(repr((CACHE_VERSION, fc.grad_board)).encode())
+    h.update(np.ascontiguousarray(initial_bufs, dtype=np.int64).tobytes())
+    h.update(np.ascontiguousarray(latencies, dtype=np.int64).tobytes())
+    return h
+
+def key_digest(k, times, vals):
+    """Hash of a single sequence dictionary key and its values"""
+    times, vals = np.atleast_1d(times), np.atleast_1d(vals)
+    h = hashlib.sha256()
+    h.update(repr((k, times.shape, vals.shape)).encode())
+    h.update(np.ascontiguousarray(times, dtype=np.int64).tobytes())
+    h.update(np.ascontiguousarray(vals, dtype=np.int64).tobytes())
+    return h.digest()
+
+def dict_key(sd, initial_bufs=np.zeros(fc.MARGA_BUFS, dtype=np.uint16), latencies=np.zeros(fc.MARGA_BUFS, dtype=np.int32), digests=None):
+    """Hash of an integer sequence dictionary and the compilation
+    settings. Key order is included, since it can affect the order of
+    simultaneous gradient updates.
+
+    digests: optional dictionary of per-key hashes kept from earlier
+    calls, so that only keys missing from it are hashed (it's filled in
+    with them); the caller must remove the keys whose values change"""
+    if digests is None:
+        digests = {}
+    h = _hasher(initial_bufs, latencies)
+    for k, (times, vals) in sd.items():
+        if k not in digests:
+            digests[k] = key_digest(k, times, vals)
+        h.update(digests[k])
+    return 'd' + h.hexdigest()
+
+def csv_key(path, quick_start=False, initial_bufs=np.zeros(fc.MARGA_BUFS, dtype=np.uint16), latencies=np.zeros(fc.MARGA_BUFS, dtype=np.int32)):
+    """Hash of a CSV or .npy sequence file's contents and the compilation settings"""
+    h = _hasher(initial_bufs, latencies)
+    h.update(repr((os.path.splitext(path)[1], quick_start)).encode())
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return 'c' + h.hexdigest()
+
+def load(key, cache_dir=None):
+    """Memory-map a cached program, or return None if it isn't in the
+    cache. The array is read-only; copy it to change it."""
+    path = os.path.join(_cache_dir(cache_dir), key + '.npy')
+    try:
+        words = np.load(path, mmap_mode='r')
+    except (FileNotFoundError, ValueError):
+        return None
+    try:
+        os.utime(path) # mark as recently used
+    except OSError:
+        pass # e.g. a read-only or shared cache; it'll just be evicted sooner
+    return words
+
+def store(key, words, cache_dir=None, max_MB=None):
+    """Save a program to the cache, then evict old programs if the
+    cache is over its size limit"""
+    cache_dir = _cache_dir(cache_dir)
+    os.makedirs(cache_dir, exist_ok=True)
+    path = os.path.join(cache_dir, key + '.npy')
+    tmp_path = '{:s}.{:d}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        np.save(f, np.asarray(words, dtype=np.uint32))
+    os.replace(tmp_path, path) # atomic, in case several processes are filling the cache
+    evict(cache_dir, compile_cache_max_MB if max_MB is None else max_MB)
+
+def evict(cache_dir=None, max_MB=None):
+    """Delete the least recently used programs until the cache is under max_MB"""
+    cache_dir = _cache_dir(cache_dir)
+    max_bytes = (compile_cache_max_MB if max_MB is None else max_MB) * 1024 * 1024
+    entries = []
+    for e in os.scandir(cache_dir):
+        if e.name.endswith('.npy'):
+            st = e.stat()
+            entries.append((st.st_mtime, st.st_size, e.path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass # removed by another process
+        total -= size
+
+def dict2bin(sd, initial_bufs=np.zeros(fc.MARGA_BUFS, dtype=np.uint16), latencies=np.zeros(fc.MARGA_BUFS, dtype=np.int32), cache_dir=None):
+    """Cached version of marcompile.dict2bin(). Note that compiler
+    warnings are only shown when a program is first compiled."""
+    key = dict_key(sd, initial_bufs, latencies)
+    words = load(key, cache_dir)
+    if words is None:
+        words = fc.dict2bin(sd, initial_bufs, latencies)
+        store(key, words, cache_dir)
+    return words
+
+def csv2bin(path, quick_start=False, initial_bufs=np.zeros(fc.MARGA_BUFS, dtype=np.uint16), latencies=np.zeros(fc.MARGA_BUFS, dtype=np.int32), cache_dir=None):
+    """Cached version of marcompile.csv2bin()"""
+    key = csv_key(path, quick_start, initial_bufs, latencies)
+    words = load(key, cache_dir)
+    if words is None:
+        words = np.asarray(fc.csv2bin(path, quick_start, initial_bufs, latencies), dtype=np.uint32)
+        store(key, words, cache_dir)
+    return words
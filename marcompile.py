@@ -2,7 +2,7 @@
 # Basic CSV -> machine code compiler for marga
 
 import numpy as np
-import warnings
+import os, warnings
 from marmachine import *
 try:
     from local_config import grad_board
@@ -14,6 +14,26 @@ st = pdb.set_trace
 
 grad_data_bufs = (1, 2)
 
+# Sequence dictionary keys, in the same order as the CSV columns
+col_arr = ['clock cycles', 'tx0_i', 'tx0_q', 'tx1_i', 'tx1_q', 'fhdo_vx', 'fhdo_vy', 'fhdo_vz', 'fhdo_vz2',
+           'ocra1_vx', 'ocra1_vy', 'ocra1_vz', 'ocra1_vz2', 'rx0_rate', 'rx1_rate',
+           'rx0_rate_valid', 'rx1_rate_valid', 'rx0_rst_n', 'rx1_rst_n', 'rx0_en', 'rx1_en',
+           'tx_gate', 'rx_gate', 'trig_out', 'leds',
+           'lo0_freq', 'lo1_freq', 'lo2_freq', 'lo0_rst', 'lo1_rst', 'lo2_rst',
+           'rx0_lo', 'rx1_lo',
+           'rx2_rate', 'rx3_rate',
+           'rx2_rate_valid', 'rx3_rate_valid', 'rx2_rst_n', 'rx3_rst_n', 'rx2_en', 'rx3_en',
+           'rx2_lo', 'rx3_lo',
+           ] + [f'ocra40_v{i}' for i in range(40)] # TODO: these rows aren't yet in the CSV and thus aren't tested by test_marga_model.py
+
+# key -> column index, to avoid searching col_arr for every key
+col_idx_table = {k: i for i, k in enumerate(col_arr)}
+
+# Changelist format used between dict2bin/csv2bin and cl2bin: one row
+# per buffer change, with the time it should be output, the buffer
+# index, the data value and the mask of the bits that are relevant
+changelist_dtype = np.dtype([('time', np.int64), ('buf', np.int32), ('val', np.int64), ('mask', np.int64)])
+
 max_removed_instructions = 1000
 
 def debug_print(*args, **kwargs):
@@ -129,7 +149,8 @@ def col2buf(col_idx, value):
     return buf_idx, val, mask
 
 def csv2bin(path, quick_start=False, initial_bufs=np.zeros(MARGA_BUFS, dtype=np.uint16), latencies = np.zeros(MARGA_BUFS, dtype=np.int32)):
-    """ initial_bufs: starting state of output buffers, to track with instructions
+    """ path: CSV execution file, or the equivalent .npy file (see csv2npy())
+    initial_bufs: starting state of output buffers, to track with instructions
     quick_start: strip out the initial RAM-writing dead time if the CSV was generated by the simulator or similar
     latencies: inherent buffer latencies to take into
     account. Latencies are primarily relevant to the gradients, but
@@ -140,36 +161,59 @@ def csv2bin(path, quick_start=False, initial_bufs=np.zeros(MARGA_BUFS, dtype=np.
     # Input: CSV column, starting from 0 for tx0 i and ending with 21 for leds
     # Output: corresponding buffer index or indices to change
 
+    if path.endswith('.npy'):
+        # binary equivalent of the CSV data, e.g. from csv2npy(); memory-mapped rather than loaded all at once
+        data = np.load(path, mmap_mode='r')
+    else:
+        data = load_csv(path)
+
+    times = data[:, 0].astype(np.int64)
+    if quick_start:
+        # remove dead time in the beginning taken up by simulated memory writes, if the input CSV is generated from the simulator
+        # times[1:] = times[1:] - times[1] + latencies.max()
+        times[1:] = times[1:] - times[1] + 10
+
+    # Compare data offset by one row in time; rows and columns of the changed values, in row order
+    rows, cols = np.nonzero(data[:-1, 1:] != data[1:, 1:])
+    rows, cols = rows + 1, cols + 1
+
+    # convert the changes in each column at once, then put them back in row order
+    cls, cell_idces, buf_ranks = [], [], []
+    col_order = np.argsort(cols, kind='stable')
+    col_starts = np.flatnonzero(np.diff(cols[col_order], prepend=-1))
+    for cells in np.split(col_order, col_starts[1:]):
+        if cells.size == 0:
+            continue
+        col_idx = cols[cells[0]]
+        buf_idces, vals, masks = col2buf(col_idx, np.asarray(data[rows[cells], col_idx]).astype(np.uint32))
+        for k, (bi, v, m) in enumerate(zip(buf_idces, vals, masks)):
+            cl = np.empty(cells.size, dtype=changelist_dtype)
+            cl['time'] = times[rows[cells]] - latencies[bi]
+            cl['buf'], cl['val'], cl['mask'] = bi, v, m
+            cls.append(cl)
+            cell_idces.append(cells)
+            buf_ranks.append(np.full(cells.size, k))
+
+    changelist = concatenate_cl(cls)
+    if changelist.size:
+        changelist = changelist[np.lexsort((np.concatenate(buf_ranks), np.concatenate(cell_idces)))]
+    grad = np.isin(changelist['buf'], grad_data_bufs)
+
+    return cl2bin(changelist[~grad], changelist[grad], initial_bufs)
+
+def load_csv(path):
+    """Read the data from a CSV execution file, checking its format"""
     data = np.loadtxt(path, skiprows=1, delimiter=',', comments='#').astype(np.uint32)
     with open(path, 'r') as csvf:
         cols = csvf.readline().strip().split(',')[1:]
 
     assert cols[-1] == ' csv_version_0.2', "Wrong CSV format"
+    return data
 
-    if quick_start:
-        # remove dead time in the beginning taken up by simulated memory writes, if the input CSV is generated from the simulator
-        # data[1:, 0] = data[1:, 0] - data[1, 0] + latencies.max()
-        data[1:, 0] = data[1:, 0] - data[1, 0] + 10
-
-    # Boolean: compare data offset by one row in time
-    data_diff = data[:-1,1:] != data[1:,1:]
-
-    changelist = []
-    changelist_grad = []
-
-    for k, dd in enumerate(data_diff):
-        clocktime = data[k + 1, 0]
-        dw = np.where(dd)[0] # indices where data changed
-        for col_idx, value in zip(dw + 1, data[k + 1][dw + 1]):
-            buf_idces, vals, masks = col2buf(col_idx, value)
-            for bi, v, m in zip(buf_idces, vals, masks):
-                change = clocktime - latencies[bi], bi, v, m
-                if bi in grad_data_bufs:
-                    changelist_grad.append(change)
-                else:
-                    changelist.append(change)
-
-    return cl2bin(changelist, changelist_grad, initial_bufs)
+def csv2npy(csv_path, npy_path):
+    """Convert a CSV execution file to the equivalent .npy file, which
+    csv2bin() can use without any text parsing"""
+    np.save(npy_path, load_csv(csv_path))
 
 def dict2bin(sd, initial_bufs=np.zeros(MARGA_BUFS, dtype=np.uint16), latencies = np.zeros(MARGA_BUFS, dtype=np.int32)):
     """sd: sequence dictionary, consisting of something in the form of:
@@ -186,83 +230,307 @@ def dict2bin(sd, initial_bufs=np.zeros(MARGA_BUFS, dtype=np.uint16), latencies =
     like slow RF amps, very long cables etc
     """
 
-    col_arr = ['clock cycles', 'tx0_i', 'tx0_q', 'tx1_i', 'tx1_q', 'fhdo_vx', 'fhdo_vy', 'fhdo_vz', 'fhdo_vz2',
-               'ocra1_vx', 'ocra1_vy', 'ocra1_vz', 'ocra1_vz2', 'rx0_rate', 'rx1_rate',
-               'rx0_rate_valid', 'rx1_rate_valid', 'rx0_rst_n', 'rx1_rst_n', 'rx0_en', 'rx1_en',
-               'tx_gate', 'rx_gate', 'trig_out', 'leds',
-               'lo0_freq', 'lo1_freq', 'lo2_freq', 'lo0_rst', 'lo1_rst', 'lo2_rst',
-               'rx0_lo', 'rx1_lo', 
-               'rx2_rate', 'rx3_rate',
-               'rx2_rate_valid', 'rx3_rate_valid', 'rx2_rst_n', 'rx3_rst_n', 'rx2_en', 'rx3_en',
-               'rx2_lo', 'rx3_lo',
-               'ocra40_v0', 'ocra40_v1', 'ocra40_v2', 'ocra40_v3', 'ocra40_v4', 'ocra40_v5', 'ocra40_v6', 'ocra40_v7',
-               'ocra40_v8', 'ocra40_v9', 'ocra40_v10', 'ocra40_v11', 'ocra40_v12', 'ocra40_v13', 'ocra40_v14', 'ocra40_v15',
-               'ocra40_v16', 'ocra40_v17', 'ocra40_v18', 'ocra40_v19', 'ocra40_v20', 'ocra40_v21', 'ocra40_v22', 'ocra40_v23',
-               'ocra40_v24', 'ocra40_v25', 'ocra40_v26', 'ocra40_v27', 'ocra40_v28', 'ocra40_v29', 'ocra40_v30', 'ocra40_v31',
-               'ocra40_v32', 'ocra40_v33', 'ocra40_v34', 'ocra40_v35', 'ocra40_v36', 'ocra40_v37', 'ocra40_v38', 'ocra40_v39',
-               ] # TODO: these two rows aren't yet in the CSV and thus aren't tested by test_marga_model.py
-
-    changelist = []
-    changelist_grad = []
-
-    for k, vals in sd.items(): # iterate over dictionary keys
-        col_idx = col_arr.index(k)
-        changelist_grad_local = []
-        buf_idces, values, masks = col2buf(col_idx, vals[1]) # single element or array of values
-        t_corr = vals[0] - latencies[buf_idces[0]]
-        for bi, vv, m in zip(buf_idces, values, masks):
-            for t, v in zip(t_corr, vv):
-                change = t, bi, v, m
-                if bi in grad_data_bufs:
-                    changelist_grad_local.append(change)
-                else:
-                    changelist.append(change)
+    return segs2bin(dict2segs(sd, initial_bufs, latencies), initial_bufs)
 
-        # needed to keep coupled LSB/MSB pairs together in case
-        # multiple events occur on different channels simultaneously
-        if len(changelist_grad_local) != 0:
-            changelist_grad_local.sort(key=lambda change: change[0])
-            changelist_grad += changelist_grad_local
+def dict2bin_repeats(sd, block_sd, repeats, period, initial_bufs=np.zeros(MARGA_BUFS, dtype=np.uint16), latencies=np.zeros(MARGA_BUFS, dtype=np.int32)):
+    """Compile a sequence dictionary together with a block (e.g. one TR)
+    which is repeated several times.
 
-    return cl2bin(changelist, changelist_grad, initial_bufs)
-
-def cl2bin(changelist, changelist_grad,
-           initial_bufs=np.zeros(MARGA_BUFS, dtype=np.uint16)):
-
-    """Central compilation function; accept in two changelists,
-    changelist for all the direct-buffer outputs (TX, most configurable
-    parameters, etc) and the other, changelist_grad, for the outputs used
-    to control hardware with non-trivial internal timing behaviour
-    (currently only the gradient boards). Also accepts non-default initial
-    values to program the buffers to."""
-
-    # Process the grad changelist, depending on what GPA is being used etc
-    # Sort in pairs of changes, because otherwise channels can get mixed up
-    changelist_grad_paired = [ [k, m] for k, m in zip(changelist_grad[::2], changelist_grad[1::2]) ]
-    sortfn = lambda change: change[0]
-    # changelist_grad.sort(key=sortfn) # sort by time
-    sortfn_paired = lambda change: change[0][0]
-    changelist_grad_paired.sort(key=sortfn_paired) # sort by time
-    changelist_grad = [k for sl in changelist_grad_paired for k in sl] # https://stackabuse.com/python-how-to-flatten-list-of-lists/
+    block_sd: sequence dictionary for the first repetition of the block;
+    each later repetition is delayed by a further period cycles. sd may
+    contain anything else, as long as all its changes come before the
+    last change of the second repetition; otherwise the repetitions in
+    the middle don't all start from the same state.
 
+    Only the first five repetitions are compiled. The machine code for
+    the repetitions in between the first two and the last one is
+    identical, so it is tiled to make up the rest of the sequence.
+    """
+    n_win = min(repeats, 5)
+    win_sd = dict(sd)
+    for k, (times, vals) in block_sd.items():
+        times, vals = np.atleast_1d(times), np.atleast_1d(vals)
+        rep_times = (times + period * np.arange(n_win)[:, None]).reshape(-1)
+        rep_vals = np.tile(vals, n_win)
+        if k in win_sd:
+            win_sd[k] = ( np.concatenate([win_sd[k][0], rep_times]), np.concatenate([win_sd[k][1], rep_vals]) )
+        else:
+            win_sd[k] = (rep_times, rep_vals)
+    segs = dict2segs(win_sd, initial_bufs, latencies)
+    if repeats <= 5:
+        return segs2bin(segs, initial_bufs)
+
+    # split the events between repetitions in the middle of the gaps between blocks
+    block_times = np.concatenate([cl['time'] for cl in dict2cl(block_sd, latencies)])
+    gap = period - (block_times.max() - block_times.min())
+    assert gap > 0, "Block is longer than the repeat period"
+    sd_times = np.concatenate([cl['time'] for cl in dict2cl(sd, latencies)])
+    if sd_times.size:
+        assert sd_times.max() < block_times.max() + period, \
+            "The rest of the sequence must end before the last change of the second repeated block"
+    cuts = block_times.min() - gap // 2 + period * np.arange(2, 5)
+
+    ev_times, ev_counts, ev_bufs, ev_vals = segs2ev(segs)
+    t_done, ev_offsets = resolve_time_offsets(ev_times, ev_counts)
+    ev_idces = np.concatenate([[0], np.searchsorted(ev_times, cuts), [ev_times.size]])
+    buf_idces = np.concatenate([[0], np.cumsum(ev_counts)])[ev_idces]
+
+    words, t_prev, buf_times = [], 0, None
+    for a, b, ba, bb in zip(ev_idces[:-1], ev_idces[1:], buf_idces[:-1], buf_idces[1:]):
+        w, t_prev, buf_times = ev2bin(t_done[a:b], ev_counts[a:b], ev_bufs[ba:bb], ev_vals[ba:bb], ev_offsets[a:b], t_prev, buf_times)
+        words.append(w)
+    first, unit, unit2, last = words
+    assert np.array_equal(unit, unit2), "Repeated blocks affect each other's timing, so cannot be tiled"
+
+    return np.concatenate([initial_words(initial_bufs), first, np.tile(unit, repeats - 3), last, instas(IFINISH, [0])])
+
+def key2cl(k, vals, latencies=np.zeros(MARGA_BUFS, dtype=np.int32)):
+    """Build the changelist for a single sequence dictionary key, and
+    the groups of buffers it contributes to. Each non-gradient buffer
+    is its own group; the gradient buffers are grouped together since
+    their changes are shifted as a whole.
+
+    A tuple of gradient keys is a block of channels sharing a time
+    axis (see block2cl())."""
+    if isinstance(k, tuple):
+        cl = block2cl(k, vals[0], vals[1], latencies)
+        return cl, ((grad_data_bufs,) if cl.size else ())
+
+    cl = col2cl(col_idx_table[k], vals[0], vals[1], latencies)
+    if cl.size == 0:
+        return cl, ()
+
+    if cl['buf'][0] in grad_data_bufs:
+        # needed to keep coupled LSB/MSB pairs together in case
+        # multiple events occur on different channels simultaneously
+        return cl[np.argsort(cl['time'], kind='stable')], (grad_data_bufs,)
+    else:
+        return cl, tuple(np.unique(cl['buf']).tolist())
+
+def dict2segs(sd, initial_bufs=np.zeros(MARGA_BUFS, dtype=np.uint16), latencies=np.zeros(MARGA_BUFS, dtype=np.int32),
+              cache=None, dirty=()):
+    """Build the event segments for a sequence dictionary, one per
+    buffer group (see key2cl()).
+
+    cache: optional dictionary, kept between calls, holding the
+    changelist of each key and the segment of each buffer group. Only
+    the keys listed in dirty (and keys which are new or have been
+    removed from sd) are rebuilt, and only the buffer groups they touch
+    are re-processed; the rest are reused from the cache. The cache is
+    reset if initial_bufs or latencies change.
+    """
+    if cache is None:
+        cache = {}
+
+    initial_bufs = np.asarray(initial_bufs)
+    latencies = np.asarray(latencies)
+    if 'initial_bufs' not in cache or not np.array_equal(cache['initial_bufs'], initial_bufs) \
+       or not np.array_equal(cache['latencies'], latencies):
+        cache.clear()
+        cache.update({'initial_bufs': initial_bufs.copy(), 'latencies': latencies.copy(), 'cl': {}, 'seg': {}})
+    cls, segs = cache['cl'], cache['seg']
+
+    # drop changelists for changed or removed keys, and the segments they went into
+    for k in set(dirty) | (cls.keys() - sd.keys()):
+        if k in cls:
+            for g in cls.pop(k)[1]:
+                segs.pop(g, None)
+
+    for k, vals in sd.items():
+        if k not in cls:
+            cls[k] = key2cl(k, vals, latencies)
+            for g in cls[k][1]:
+                segs.pop(g, None)
+
+    for k, (cl, groups) in cls.items():
+        for g in groups:
+            if g in segs:
+                continue
+            if g == grad_data_bufs:
+                changelist_grad = concatenate_cl([cls[j][0] for j in sd if g in cls[j][1]])
+                segs[g] = cl2seg(grad2cl(changelist_grad, initial_bufs)[0], initial_bufs)
+            else:
+                changelist = concatenate_cl([cls[j][0][cls[j][0]['buf'] == g] for j in sd if g in cls[j][1]])
+                changelist = changelist[np.argsort(changelist['time'], kind='stable')] # sort by time
+                segs[g] = cl2seg(changelist, initial_bufs)
+
+    if len(segs) == 0:
+        return [cl2seg(concatenate_cl([]), initial_bufs)]
+    return list(segs.values())
+
+def dict2template(sd, template_keys, initial_bufs=np.zeros(MARGA_BUFS, dtype=np.uint16), latencies=np.zeros(MARGA_BUFS, dtype=np.int32)):
+    """Compile a sequence dictionary as for dict2bin(), but keep every
+    change to the buffers controlled by template_keys even if it has no
+    effect, so that the program's timing doesn't depend on their
+    values. Record where each of their values lands in the machine
+    code, so that new values with the same timing can later be written
+    in by patch_template() without recompiling.
+
+    template_keys: keys of sd which control whole buffers (TX and gradient keys)
+
+    Returns (machine code, template)"""
+    keys = [k for k in sd if len(sd[k][0])]
+    for k in template_keys:
+        assert k in keys, "Template key {:s} is not in the sequence".format(k)
+        assert np.all(np.array(col2buf(col_idx_table[k], 0)[2]) == 0xffff), "Template key {:s} does not control whole buffers".format(k)
+
+    # changelists for the direct and gradient buffers, with the key and key index each change came from
+    cls, src_keys, src_idces = ([], []), ([], []), ([], [])
+    for ki, k in enumerate(keys):
+        cl, groups = key2cl(k, sd[k], latencies)
+        grad = grad_data_bufs in groups
+        cls[grad].append(cl)
+        src_keys[grad].append(np.full(cl.size, ki))
+        src_idces[grad].append(np.arange(cl.size))
+    cls = [concatenate_cl(c) for c in cls]
+    src_keys = [np.concatenate(s + [[]]).astype(np.int64) for s in src_keys]
+    src_idces = [np.concatenate(s + [[]]).astype(np.int64) for s in src_idces]
+
+    tk_idces = [keys.index(k) for k in template_keys]
+    keep_bufs = np.concatenate([c['buf'][np.isin(s, tk_idces)] for c, s in zip(cls, src_keys)])
+
+    time_order = np.argsort(cls[0]['time'], kind='stable') # sort by time
+    changelist_grad, grad_order = grad2cl(cls[1], initial_bufs)
+    orders = (time_order, grad_order)
+    segs = [cl2seg(cls[0][time_order], initial_bufs, keep_bufs), cl2seg(changelist_grad, initial_bufs, keep_bufs)]
+
+    ev_times, ev_counts, ev_bufs, ev_vals, (seg_idx, seg_src) = segs2ev(segs, return_src=True)
+    ev_times, ev_offsets = resolve_time_offsets(ev_times, ev_counts)
+    ev_words, _, _ = ev2bin(ev_times, ev_counts, ev_bufs, ev_vals, ev_offsets)
+    words = np.concatenate([initial_words(initial_bufs), ev_words, instas(IFINISH, [0])])
+
+    # buffer writes are the only instructions with the top bit set, and are in the same order as the events
+    word_idces = np.flatnonzero(words & 0x80000000)[len(initial_bufs):]
+
+    # for each buffer write, where it came from in the concatenated changelists
+    ev_src = np.empty(seg_idx.size, dtype=np.int64)
+    for si, order in enumerate(orders):
+        ev_src[seg_idx == si] = order[seg_src[seg_idx == si]]
+
+    template = {}
+    for k, ki in zip(template_keys, tk_idces):
+        col_idx = col_idx_table[k]
+        cl = col2cl(col_idx, sd[k][0], sd[k][1], latencies)
+        # key2cl() sorts gradient changes by time; map back to the order of col2cl()
+        cl_order = np.argsort(cl['time'], kind='stable') if cl['buf'][0] in grad_data_bufs else np.arange(cl.size)
+        pos = np.full(cl.size, -1, dtype=np.int64)
+        keep = np.zeros(cl.size, dtype=np.uint32)
+        for si in range(2):
+            sel = seg_idx == si
+            sel[sel] = src_keys[si][ev_src[sel]] == ki
+            cl_idces = cl_order[src_idces[si][ev_src[sel]]]
+            pos[cl_idces] = word_idces[sel]
+            # keep any bits changed during processing, e.g. the gradient broadcast bit
+            keep[cl_idces] = 0xffff & ~(cl['val'][cl_idces] ^ ev_vals[sel])
+        assert np.all(pos >= 0), "Template key {:s} changes a buffer more than once at the same time".format(k)
+        template[k] = (col_idx, pos, keep)
+
+    return words, template
+
+def patch_template(words, template, sd):
+    """Write new values for template keys, from a sequence dictionary
+    with the same times as was passed to dict2template(), directly into
+    the machine code words in place"""
+    for k, (_, vals) in sd.items():
+        col_idx, pos, keep = template[k]
+        vals = np.atleast_1d(vals)
+        new_vals = np.concatenate([np.broadcast_to(v, vals.shape) for v in col2buf(col_idx, vals)[1]])
+        assert new_vals.size == pos.size, "Number of values for template key {:s} has changed".format(k)
+        words[pos] = (words[pos] & 0xffff0000) | (new_vals.astype(np.uint32) & keep)
+
+def col2cl(col_idx, times, values, latencies=np.zeros(MARGA_BUFS, dtype=np.int32)):
+    """Build the structured changelist for a single column, from whole
+    arrays of event times and values. Entries are ordered by buffer
+    (in the order returned by col2buf), then by the order of the
+    input events."""
+    times = np.atleast_1d(times)
+    buf_idces, vals, masks = col2buf(col_idx, np.atleast_1d(values))
+    n = times.size
+
+    cl = np.empty(len(buf_idces) * n, dtype=changelist_dtype)
+    cl['time'] = np.tile(times - latencies[buf_idces[0]], len(buf_idces))
+    for k, (bi, v, m) in enumerate(zip(buf_idces, vals, masks)):
+        cl['buf'][k*n:(k+1)*n] = bi
+        cl['val'][k*n:(k+1)*n] = v
+        cl['mask'][k*n:(k+1)*n] = m
+    return cl
+
+def block2cl(keys, times, values, latencies=np.zeros(MARGA_BUFS, dtype=np.int32)):
+    """Build the gradient changelist for a block of channels sharing
+    one time axis. keys is a tuple of gradient keys, and values has one
+    row per key. The times must be increasing, so the (MSB, LSB) pairs
+    come out ordered by time then by key without any sorting -- the
+    same order as for separate keys in dict2segs()."""
+    times = np.atleast_1d(times)
+    values = np.atleast_2d(values)
+    assert values.shape == (len(keys), times.size), "Block values must have one row per key and one column per time"
+    n_ch, n = values.shape
+
+    cl = np.empty((n, n_ch, 2), dtype=changelist_dtype) # time, channel, (MSB, LSB)
+    for c, k in enumerate(keys):
+        buf_idces, vals, masks = col2buf(col_idx_table[k], values[c])
+        assert sorted(buf_idces) == list(grad_data_bufs), "Only gradient keys can be combined into a block"
+        cl['time'][:, c, :] = (times - latencies[buf_idces[0]])[:, None]
+        for p, (bi, v, m) in enumerate(zip(buf_idces, vals, masks)):
+            cl['buf'][:, c, p] = bi
+            cl['val'][:, c, p] = v
+            cl['mask'][:, c, p] = m
+    return cl.reshape(-1)
+
+def concatenate_cl(cls):
+    """Join a list of structured changelists; accepts an empty list"""
+    if len(cls) == 0:
+        return np.empty(0, dtype=changelist_dtype)
+    return np.concatenate(cls)
+
+def shift_grad_changes(changelist_grad, spi_div):
+    """Process the grad changelist, depending on what GPA is being used
+    etc. The changelist must consist of (MSB, LSB) pairs sorted by
+    time; simultaneous OCRA1/OCRA40 updates are moved back into the past
+    with broadcast turned off, so that synchronisation will be done in
+    the ocra1_iface core."""
+    msbs, lsbs = changelist_grad[0::2], changelist_grad[1::2]
+    if not ( np.all(msbs['buf'] == GRAD_MSB) and np.all(lsbs['buf'] == GRAD_LSB)
+             and np.all(msbs['time'] == lsbs['time']) ):
+        # pairs are not aligned (e.g. repeated times within a channel); fall back to processing one change at a time
+        return shift_grad_changes_unpaired(changelist_grad, spi_div)
+
+    # group simultaneous pairs; no updates have previously happened, so time 0 counts as simultaneous with the past
+    t = msbs['time']
+    new_time = t != np.concatenate([[0], t[:-1]])
+    group_starts = np.flatnonzero(new_time)
+    if np.any(np.diff(t[group_starts], prepend=0) < 24 * (1 + spi_div) + 2):
+        warnings.warn("Gradient updates are too frequent for selected SPI divider. Missed samples are likely!", MarGradWarning)
+
+    shifted = changelist_grad.copy()
+    if grad_board == "ocra1" or grad_board == "ocra40": # simultaneous with another grad update
+        # rank of each pair within its group of simultaneous updates, counting from the first update which keeps its timing
+        idces = np.arange(t.size)
+        rank = idces - np.maximum.accumulate(np.where(new_time, idces, -1))
+        delayed = rank > 0
+        offset = np.where(delayed, 2 * rank - 1, 0)
+        shifted['time'][0::2] -= offset
+        shifted['time'][1::2] -= offset
+        # turn broadcast off if this isn't the first grad event on this timestep
+        shifted['val'][0::2][delayed] &= ~0x0100
+    # for the GPA-FHDO, don't do anything; currently will cause an
+    # error later since multiple events can't happen at the same time
+
+    return shifted
+
+def shift_grad_changes_unpaired(changelist_grad, spi_div):
+    """Reference implementation of shift_grad_changes(), for changelists
+    where MSB/LSB changes are not stored in matching pairs"""
     t_last = [0, 0] # no updates have previously happened; [LSB, MSB]
-    spi_div = (initial_bufs[0] & 0xfc) >> 2
     changelist_grad_shifted = []
     num_chgs = [0, 0] # [LSB, MSB]
-    grad_vals = [initial_bufs[1], initial_bufs[2]] # [LSB, MSB] current output data
-    grad_vals_old = [0, 0] # [LSB, MSB] previous output data
 
-    for c in changelist_grad:
+    for c in changelist_grad.tolist():
         t = c[0]
         debug_print("t: ", t, " t_last: ", t_last, "num_chgs: ", num_chgs, " c: ", c)
         idx = c[1] - 1 # 0 for LSB, 1 for MSB
         msb = idx == 1
         data = c[2]
-        # if data == grad_vals[idx]: # no actual change to buffer output
-        #     continue # skip this change
-        # else:
-        #     grad_vals_old[idx] = grad_vals[idx]
-        #     grad_vals[idx] = data # update the last known buffer value
 
         if t == t_last[idx]:
             num_chgs[idx] += 1
@@ -273,11 +541,6 @@ def cl2bin(changelist, changelist_grad,
                     if num_chgs[1]: # MSB buffer and not the first grad event on this timestep
                         # turn broadcast off if this isn't the first grad event on this timestep
                         data = data & ~0x0100
-                        # return LSB back to old values, since this one is now done in the past
-                        grad_vals[:] = grad_vals_old # revert the last known buffer values
-                # else:
-                #     if data == grad_vals[idx]: # no actual change to buffer output compared to earlier LSB at this timestep
-                #         continue # skip this change
 
                 # move non-broadcast events back in time, so that synchronisation will be done in ocra1_iface core
                 changelist_grad_shifted.append( (c[0]-num_chgs[idx], c[1], data, c[3]) )
@@ -286,166 +549,386 @@ def cl2bin(changelist, changelist_grad,
                 # don't do anything; currently will cause an error
                 # later since multiple events can't happen at the same
                 # time for GPA-FHDO
-                changelist_grad_shifted.append(c)     
+                changelist_grad_shifted.append(c)
         else:
             if t - t_last[idx] < 24 * (1 + spi_div) + 2: #
                 warnings.warn("Gradient updates are too frequent for selected SPI divider. Missed samples are likely!", MarGradWarning)
 
-            # if data == grad_vals[idx]: # no actual change to buffer output
-            #     continue # skip this change
-
             t_last[idx] = t
-            grad_vals[idx] = data # update the last known buffer value
             changelist_grad_shifted.append(c)
             num_chgs = [0, 0]
 
-    changelist += changelist_grad_shifted
-    changelist.sort(key=sortfn) # sort by time
+    return np.array(changelist_grad_shifted, dtype=changelist_dtype)
+
+def masked_scan(bufs, vals, masks, initial_bufs):
+    """Replay a series of masked buffer writes, already grouped by buffer
+    and in execution order. Returns the value of each write's buffer
+    before and after the write is applied."""
+    n = bufs.size
+    idces = np.arange(n)
+    seg_start = np.maximum.accumulate(np.where(np.concatenate([[True], bufs[1:] != bufs[:-1]]), idces, 0))
+    vals = vals & 0xffff
+
+    after = vals.copy()
+    partial = masks != 0xffff
+    if np.any(partial):
+        # only buffers with partial writes need to be replayed bit by bit: each output bit comes from the
+        # last write that included it in its mask, or from the initial buffer value
+        sel = np.flatnonzero(np.isin(bufs, bufs[partial]))
+        sel_bufs, sel_vals, sel_masks = bufs[sel], vals[sel], masks[sel]
+        sel_idces = np.arange(sel.size)
+        sel_start = np.maximum.accumulate(np.where(seg_start[sel] == sel, sel_idces, 0))
+        sel_after = np.zeros(sel.size, dtype=after.dtype)
+        for bit in range(16):
+            bm = 1 << bit
+            last_set = np.maximum.accumulate(np.where(sel_masks & bm, sel_idces, -1))
+            sel_after |= np.where(last_set >= sel_start, sel_vals[np.maximum(last_set, 0)], initial_bufs[sel_bufs]) & bm
+        after[sel] = sel_after
+
+    before = np.empty_like(after)
+    before[1:] = after[:-1]
+    before[seg_start == idces] = initial_bufs[bufs[seg_start == idces]]
+    return before, after
+
+def cl2seg(changelist, initial_bufs=np.zeros(MARGA_BUFS, dtype=np.uint16), keep_bufs=()):
+    """Process a changelist, time-sorted for each buffer, into an event
+    segment: the values each buffer changes to and when. Buffers are
+    processed independently of each other, so segments for separate
+    sets of buffers can be built separately and later combined into
+    discrete sets of operations at each time with segs2ev().
+
+    Returns a dictionary with:
+    times: unique times of all the changes (including the ones that have no effect)
+    time, buf, val: final value of each buffer which changed on each timestep, ordered by buffer then time
+    src: index in changelist of the change which set each final value
+    removed: the changes which have no effect on their buffer, and will be dropped
+    final_bufs: (buffers, values) at the end of the changelist
+
+    keep_bufs: buffers for which changes are never dropped, even if they have no effect
+    """
+    initial_bufs = np.asarray(initial_bufs).astype(np.int64)
+    n = changelist.size
+
+    # replay the writes to each buffer in turn
+    order = np.argsort(changelist['buf'], kind='stable')
+    t, b, v, m = changelist['time'][order], changelist['buf'][order], changelist['val'][order], changelist['mask'][order]
+    before, after = masked_scan(b, v, m, initial_bufs)
+    buf_diff = (before ^ v) & m
+    changed = (buf_diff != 0) | np.isin(b, keep_bufs)
+
+    # groups of writes to the same buffer at the same time
+    group_start = np.concatenate([[True], (b[1:] != b[:-1]) | (t[1:] != t[:-1])])
+    group_end = np.concatenate([group_start[1:], [True]])
+
+    # a write cannot alter bits which an earlier write on the same timestep has already changed
+    multi = ~(group_start & group_end)
+    if np.any(multi):
+        idces = np.flatnonzero(multi)
+        gs = np.maximum.accumulate(np.where(group_start[idces], np.arange(idces.size), 0))
+        eff_masks = np.where(changed[idces], m[idces], 0)
+        for bit in range(16):
+            bm = 1 << bit
+            set_count = np.cumsum((eff_masks & bm) != 0)
+            prior = set_count - ((eff_masks & bm) != 0) - (set_count[gs] - ((eff_masks[gs] & bm) != 0))
+            assert not np.any( (buf_diff[idces] & bm != 0) & (prior > 0) ), "Tried to set a buffer to two values at once"
+
+    group_changed = np.logical_or.reduceat(changed, np.flatnonzero(group_start)) if n else np.zeros(0, dtype=bool)
+    out = np.flatnonzero(group_end)[group_changed]
+    seg_end = np.concatenate([b[1:] != b[:-1], [True]]) if n else np.zeros(0, dtype=bool)
+
+    return {'times': np.unique(t),
+            'time': t[out], 'buf': b[out], 'val': after[out].astype(np.uint16), 'src': order[out],
+            'removed': changelist[np.sort(order[~changed])],
+            'final_bufs': (b[seg_end], after[seg_end].astype(np.uint16))}
+
+def removed_changes(segs):
+    """Changes which have no effect in a list of event segments, sorted
+    by time. Gradient buffers will have unneeded instructions all the
+    time, so not worth warning the user for those"""
+    removed = concatenate_cl([s['removed'] for s in segs])
+    removed = removed[(removed['buf'] != GRAD_LSB) & (removed['buf'] != GRAD_MSB)]
+    return removed[np.argsort(removed['time'], kind='stable')]
+
+def warn_removed(removed):
+    for time, buf, val, mask in removed.tolist():
+        warnings.warn("Instruction at tick {:d}, buffer {:d}, value 0x{:04x}, mask 0x{:04x} will have no effect. Skipping...".format(time, buf, val, mask), MarRemovedInstructionWarning)
+
+def segs2ev(segs, return_src=False, check_removed=True):
+    """Combine event segments from cl2seg() into discrete sets of operations
+    at each time, i.e. an output list.
+
+    Returns (times, counts, bufs, vals): the unique event times, the
+    number of buffers changed at each time, and the changed buffers and
+    their new values (flattened, ordered by time then buffer).
+
+    return_src: also return the (segment index, src) each buffer change came from
+
+    check_removed: warn about the removed changes, if there are many of them"""
+    ev_times = np.unique(np.concatenate([s['times'] for s in segs]))
+    t = np.concatenate([s['time'] for s in segs])
+    b = np.concatenate([s['buf'] for s in segs])
+    v = np.concatenate([s['val'] for s in segs])
+    order = np.lexsort((b, t))
+    ev_counts = np.bincount(np.searchsorted(ev_times, t[order]), minlength=ev_times.size)
 
     # Track removed instruction events, but only warn when the number exceeds a minimum
-    removed_instruction_warnings = []
-
-    # Process and combine the change list into discrete sets of operations at each time, i.e. an output list
-    def cl2ol(changelist):
-        current_bufs = initial_bufs.copy()
-        current_time = changelist[0][0]
-        unique_times = []
-        unique_changes = []
-        change_masks = np.zeros(MARGA_BUFS, dtype=np.uint16)
-        changed = np.zeros(MARGA_BUFS, dtype=bool)
-
-        def close_timestep(time):
-            ch_idces = np.where(changed)[0]
-            # buf_time_offsets = np.zeros(MARGA_BUFS, dtype=int32)
-            buf_time_offsets = 0
-            unique_changes.append( [time, ch_idces, current_bufs[ch_idces], buf_time_offsets] )
-            change_masks[:] = np.zeros(MARGA_BUFS, dtype=np.uint16)
-            changed[:] = np.zeros(MARGA_BUFS, dtype=bool)
-
-        for time, buf, val, mask in changelist:
-            if time != current_time:
-                close_timestep(current_time)
-                current_time = time
-            buf_diff = (current_bufs[buf] ^ val) & mask
-            assert buf_diff & change_masks[buf] == 0, "Tried to set a buffer to two values at once"
-            if buf_diff == 0:
-                if buf not in (1, 2):
-                    # gradient buffers will have unneeded instructions
-                    # all the time, so not worth warning the user for
-                    # those
-                    removed_instruction_warnings.append( "Instruction at tick {:d}, buffer {:d}, value 0x{:04x}, mask 0x{:04x} will have no effect. Skipping...".format(time, buf, val, mask) )
-                continue
-            val_masked = val & mask
-            old_val_unmasked = current_bufs[buf] & ~mask
-            new_val = old_val_unmasked | val_masked
-            change_masks[buf] |= mask
-            current_bufs[buf] = new_val
-            changed[buf] = True
-
-        close_timestep(current_time)
-
-        return unique_changes
-
-    changes = cl2ol(changelist)
-
-    # warn about all the removed instructions if there are more than a maximum number
-    if len(removed_instruction_warnings) > max_removed_instructions:
-        for riw in removed_instruction_warnings:
-            warnings.warn(riw, MarRemovedInstructionWarning)
-        warnings.warn("NOTE: Fewer than {:d} removed-instruction warnings will not be printed -- keep this in mind when searching for the root cause.".format(max_removed_instructions))
-
-    # Process time offsets
-    for ch, ch_prev in zip( reversed(changes[1:]), reversed(changes[:-1]) ):
-        # does the current timestep need to output more data than can
-        # fit into the time gap since the previous timestep?
-        timestep = ch[0] - ch_prev[0]
-        timediff = ch[1].size - timestep
-        # if timestep < ch[1].size: # not enough time
-
-        if timediff > 0:
-            ch_prev[0] -= timediff # move prev. event into the past
-            ch_prev[3] = timediff # make prev. event's buffers output in its future
-
-    # convert to differential timesteps
-    last_time = 0
-    for ch in changes:
-        ch0 = ch[0]
-        ch[0] = ch0 - last_time
-        last_time = ch0
-
-    # Interpretation of each element of changes list:
-    # [time when all instructions for this change will have completed,
-    #  buffers that need to be changed,
-    #  values to set the buffers to,
-    #  the delay until the buffers will output their values]
-
-    ### Write out instructions
-
-    # Write out initial buffer values
-    bdata = []
-    addr = 0
-    states = initial_bufs
-    # reversed order, so that grad board is enabled last of all (to avoid spurious initial transfer)
-    for k, ib in enumerate(reversed(initial_bufs)):
-        bdata.append(instb(MARGA_BUFS-1-k, k, ib))
-
-    last_buf_time_left = np.zeros(MARGA_BUFS, dtype=np.int32)
-    buf_time_left = np.zeros(MARGA_BUFS, dtype=np.int32)
-    # buf_empty_time = np.zeros(MARGA_BUFS, dtype=np.int32)
-    debug_print("changes:")
-    for k in changes:
-        debug_print(k)
-
-    for event in changes:
-        b_instrs = event[1].size
-        dtime = event[0]
-
-        # soak up any extra time which is in excess of what the instructions need to execute synchronously
-        excess_dtime = dtime - b_instrs
-        excess_dtime_tmp = excess_dtime
-        while excess_dtime_tmp > 2: # delay of 3 or more cycles needed
-            wait_time = min(excess_dtime_tmp, COUNTER_MAX + 3) # delay for the time instruction
-            bdata.append(insta(IWAIT, wait_time - 3))
-            excess_dtime_tmp -= wait_time
-            debug_print("i wait ", wait_time - 3)
-        if excess_dtime_tmp: # final delay of 1 or 2 cycles
-            for k in range(dtime - b_instrs):
-                debug_print("i nop")
-                bdata.append(insta(INOP, 0))
-
-        # time left after delays from nops or waits
-        # dtime_eff could be increased later with a more advanced
-        # compiler, to make the buffers bear more of the internal
-        # delays
-        # dtime_eff = b_instrs
-
-        # count down the times until each channel buffer will be empty
-        buf_time_left -= excess_dtime
-        buf_time_left[buf_time_left < 0] = 0
-        this_time_offset = event[3]
-        debug_print("--- dtime {:2d}, this_time_offset: {:2d}, b_instrs: {:2d}, lbtl: ".format(dtime, this_time_offset, b_instrs), last_buf_time_left[5:9])
-        for m, (ind, dat) in enumerate(zip(event[1], event[2])):
-            execution_delay = b_instrs - m - 1 #+ time - 2
-            btli = buf_time_left[ind]
-            buf_empty = btli <= m # or <= m, need to check
-            if buf_empty: # buffer empty for this instruction; need an appropriate delay only for sync
-                # (check against m since with successive cycles, remaining buffers will empty out)
-                extra_delay = execution_delay + this_time_offset
-                buf_time_left[ind] = this_time_offset + b_instrs
-            else:
-                # buffer already not empty on this cycle
-                extra_delay = this_time_offset - btli + b_instrs - 1
-                buf_time_left[ind] += extra_delay + 1
+    if check_removed:
+        removed = removed_changes(segs)
+        if removed.size > max_removed_instructions:
+            warn_removed(removed)
+            warn_removed_note()
+
+    if return_src:
+        seg_idx = np.repeat(np.arange(len(segs)), [s['time'].size for s in segs])
+        src = np.concatenate([s['src'] for s in segs])
+        return ev_times, ev_counts, b[order], v[order], (seg_idx[order], src[order])
+    return ev_times, ev_counts, b[order], v[order]
+
+def warn_removed_note():
+    warnings.warn("NOTE: Fewer than {:d} removed-instruction warnings will not be printed -- keep this in mind when searching for the root cause.".format(max_removed_instructions))
+
+def grad2cl(changelist_grad, initial_bufs=np.zeros(MARGA_BUFS, dtype=np.uint16)):
+    """Sort the grad changelist in pairs of changes, because otherwise
+    channels can get mixed up, then shift simultaneous changes and sort
+    them again by time.
+
+    Returns the processed changelist, and the index in changelist_grad
+    of each of its changes"""
+    n_pairs = changelist_grad.size // 2
+    pair_order = np.argsort(changelist_grad['time'][0:n_pairs*2:2], kind='stable') # sort by time
+    order = (2 * pair_order[:, None] + np.arange(2)).reshape(-1)
 
-            debug_print("bti={:d} btli={:d} m={:d} empty={:d} edel={:d} instb i {:d} del {:d} dat {:d}".format(
-                buf_time_left[ind], btli, m, buf_empty, execution_delay, ind, extra_delay, dat))
-            bdata.append(instb(ind, extra_delay, dat))
+    spi_div = (initial_bufs[0] & 0xfc) >> 2
+    changelist_grad = shift_grad_changes(changelist_grad[order], spi_div)
+    time_order = np.argsort(changelist_grad['time'], kind='stable')
+    return changelist_grad[time_order], order[time_order]
 
-        buf_time_left -= b_instrs # take into account execution time of this timestep
+def segs2bin(segs, initial_bufs=np.zeros(MARGA_BUFS, dtype=np.uint16)):
+    """Write out the complete program for a list of event segments"""
+    ev_times, ev_counts, ev_bufs, ev_vals = segs2ev(segs)
+    ev_times, ev_offsets = resolve_time_offsets(ev_times, ev_counts)
+    ev_words, _, _ = ev2bin(ev_times, ev_counts, ev_bufs, ev_vals, ev_offsets)
 
-    # Finish sequence
-    bdata.append(insta(IFINISH, 0))
-    return bdata
+    return np.concatenate([initial_words(initial_bufs), ev_words, instas(IFINISH, [0])])
+
+def cl2bin(changelist, changelist_grad,
+           initial_bufs=np.zeros(MARGA_BUFS, dtype=np.uint16)):
+
+    """Central compilation function; accept in two changelists,
+    changelist for all the direct-buffer outputs (TX, most configurable
+    parameters, etc) and the other, changelist_grad, for the outputs used
+    to control hardware with non-trivial internal timing behaviour
+    (currently only the gradient boards). Also accepts non-default initial
+    values to program the buffers to.
+
+    Changelists are structured arrays of changelist_dtype, with
+    (time, buf, val, mask) columns; lists of such tuples are also accepted."""
+
+    changelist = np.asarray(changelist, dtype=changelist_dtype)
+    changelist_grad = np.asarray(changelist_grad, dtype=changelist_dtype)
+
+    changelist = changelist[np.argsort(changelist['time'], kind='stable')] # sort by time
+    segs = [cl2seg(changelist, initial_bufs), cl2seg(grad2cl(changelist_grad, initial_bufs)[0], initial_bufs)]
+    return segs2bin(segs, initial_bufs)
+
+def dict2cl(sd, latencies=np.zeros(MARGA_BUFS, dtype=np.int32)):
+    """Build the direct-buffer and gradient changelists for a sequence
+    dictionary, as accepted by cl2bin()"""
+    changelist, changelist_grad = [], []
+    for k, vals in sd.items():
+        cl, groups = key2cl(k, vals, latencies)
+        if grad_data_bufs in groups:
+            changelist_grad.append(cl)
+        else:
+            changelist.append(cl)
+    return concatenate_cl(changelist), concatenate_cl(changelist_grad)
+
+def cl2bin_stream(chunks, initial_bufs=np.zeros(MARGA_BUFS, dtype=np.uint16), min_gap=None):
+    """Streaming version of cl2bin(), for sequences too long to compile in one go.
+
+    chunks: iterable of (changelist, changelist_grad) tuples in time
+    order, i.e. no change in a chunk may be earlier than the changes
+    in the chunks before it
+
+    Changes are compiled in batches, split wherever there are at least
+    min_gap cycles without any changes, so memory use depends on the
+    length of the longest stretch without such a gap rather than on the
+    length of the sequence. The buffer values and output times are
+    carried over from one batch to the next. By default min_gap is the
+    shortest gradient update interval allowed by the SPI divider.
+
+    Yields uint32 arrays of machine code, which concatenated are the same
+    as the output of cl2bin() for the whole sequence. If the changes are
+    too dense around a gap for it to be compiled separately (i.e. a later
+    batch would need to move instructions into an earlier one), an
+    AssertionError is raised; increase min_gap in that case.
+    """
+    initial_bufs = np.asarray(initial_bufs)
+    spi_div = (initial_bufs[0] & 0xfc) >> 2
+    if min_gap is None:
+        min_gap = max(24 * (1 + spi_div) + 2, 256)
+
+    yield initial_words(initial_bufs)
+
+    bufs = initial_bufs.astype(np.int64) # buffer values at the end of the compiled changes
+    pending = [concatenate_cl([]), concatenate_cl([])] # changes not compiled yet
+    ev_pending = None # events from the last batch, held back in case the next batch moves them into the past
+    t_prev, buf_times = 0, None # state after the last written-out event
+    t_compiled = -1 # time of the last compiled event
+    written = False
+    removed_held, n_removed = [], 0
+
+    chunks = iter(chunks)
+    while True:
+        chunk = next(chunks, None)
+        if chunk is not None:
+            cls = [np.asarray(c, dtype=changelist_dtype) for c in chunk]
+            assert all(np.all(c['time'] > t_compiled) for c in cls), "Chunks must be in time order"
+            pending = [concatenate_cl([p, c]) for p, c in zip(pending, cls)]
+
+            # compile up to the last long gap
+            times = np.sort(np.concatenate([p['time'] for p in pending]))
+            gaps = np.flatnonzero(np.diff(times) >= min_gap)
+            if gaps.size == 0:
+                continue
+            t_cut = times[gaps[-1] + 1]
+        else:
+            t_cut = np.inf # compile everything
+
+        changelist, changelist_grad = (p[p['time'] < t_cut] for p in pending)
+        pending = [p[p['time'] >= t_cut] for p in pending]
+
+        changelist = changelist[np.argsort(changelist['time'], kind='stable')] # sort by time
+        changelist_grad = grad2cl(changelist_grad, initial_bufs)[0]
+        segs = [cl2seg(changelist, bufs), cl2seg(changelist_grad, bufs)]
+        for s in segs:
+            bufs[s['final_bufs'][0]] = s['final_bufs'][1]
+        ev = segs2ev(segs, check_removed=False)
+        if ev[0].size:
+            assert ev[0][0] > t_compiled, "Gradient updates moved into the previous batch; increase min_gap"
+            t_compiled = ev[0][-1]
+
+        # Track removed instruction events, but only warn when the number exceeds a minimum
+        removed = removed_changes(segs)
+        n_removed += removed.size
+        if n_removed > max_removed_instructions:
+            warn_removed(concatenate_cl(removed_held + [removed]))
+            removed_held = []
+        else:
+            removed_held.append(removed)
+
+        # resolve offsets together with the events held back from the previous batch
+        n_held = 0
+        if ev_pending is not None:
+            n_held = ev_pending[0].size
+            ev = [np.concatenate([a, b]) for a, b in zip(ev_pending, ev)]
+        ev_times, ev_counts, ev_bufs, ev_vals = ev
+        t_done, ev_offsets = resolve_time_offsets(ev_times, ev_counts)
+        if written and ev_times.size:
+            assert t_done[0] - ev_counts[0] >= t_prev, "Changes too dense to be compiled in separate batches; increase min_gap"
+
+        # write out the held-back events, or everything at the end of the sequence
+        n_out = ev_times.size if chunk is None else n_held
+        n_out_bufs = ev_counts[:n_out].sum()
+        if n_out:
+            words, t_prev, buf_times = ev2bin(t_done[:n_out], ev_counts[:n_out], ev_bufs[:n_out_bufs], ev_vals[:n_out_bufs], ev_offsets[:n_out], t_prev, buf_times)
+            written = True
+            yield words
+        ev_pending = ev_times[n_out:], ev_counts[n_out:], ev_bufs[n_out_bufs:], ev_vals[n_out_bufs:]
+
+        if chunk is None:
+            break
+
+    if n_removed > max_removed_instructions:
+        warn_removed_note()
+    yield instas(IFINISH, [0])
+
+def dict2bin_stream(sd_chunks, initial_bufs=np.zeros(MARGA_BUFS, dtype=np.uint16), latencies=np.zeros(MARGA_BUFS, dtype=np.int32), min_gap=None):
+    """Streaming version of dict2bin(); sd_chunks is an iterable of
+    sequence dictionaries, each covering a later stretch of time than the
+    ones before it. See cl2bin_stream()."""
+    return cl2bin_stream((dict2cl(sd, latencies) for sd in sd_chunks), initial_bufs, min_gap)
+
+def initial_words(initial_bufs):
+    """Write out initial buffer values, in reversed order, so that grad
+    board is enabled last of all (to avoid spurious initial transfer)"""
+    n = len(initial_bufs)
+    return instbs(MARGA_BUFS - 1 - np.arange(n), np.arange(n), np.asarray(initial_bufs)[::-1])
+
+def resolve_time_offsets(ev_times, ev_counts):
+    """If a timestep needs to output more data than can fit into the time
+    gap since the previous timestep, move the previous timestep into the
+    past, and make its buffers output in its future.
+
+    Returns the times when all instructions for each event will have
+    completed, and the delays until the buffers will output their values."""
+    # each event must complete at least as many cycles before the next one as the next one has instructions:
+    # t_done[k] = min(t[k], t_done[k+1] - n[k+1]), solved as a reversed cumulative minimum
+    n_cum = np.cumsum(ev_counts)
+    t_done = np.minimum.accumulate( (ev_times - n_cum)[::-1] )[::-1] + n_cum
+    return t_done, ev_times - t_done
+
+def ev2bin(ev_times, ev_counts, ev_bufs, ev_vals, ev_offsets, t_prev=0, buf_times=None):
+    """Write out the instructions for a series of events, as returned by
+    cl2ol() and resolve_time_offsets(), into a single uint32 array.
+
+    t_prev: completion time of the event preceding the first one, or 0 at
+    the start of a sequence
+
+    buf_times: for each buffer, the output time of its last write before
+    the first event (zeros at the start of a sequence)
+
+    Returns (words, t_last, buf_times) so that a later series of events
+    can be written out to follow on from this one."""
+    if buf_times is None:
+        buf_times = np.zeros(MARGA_BUFS, dtype=np.int64)
+    n_ev = ev_times.size
+
+    # soak up any extra time which is in excess of what the instructions need to execute synchronously
+    dtime = np.diff(ev_times, prepend=t_prev)
+    excess = dtime - ev_counts
+    full_waits, rem = np.divmod(np.maximum(excess, 0), COUNTER_MAX + 3)
+    part_wait = rem > 2 # delay of 3 or more cycles needed
+    n_waits = full_waits + part_wait
+    n_nops = np.where(part_wait, 0, rem) # final delay of 1 or 2 cycles
+
+    ev_sizes = n_waits + n_nops + ev_counts
+    ev_starts = np.cumsum(ev_sizes) - ev_sizes
+    words = np.zeros(ev_sizes.sum(), dtype=np.uint32) # zeros are INOP instructions
+
+    if np.any(n_waits):
+        wait_ev = np.repeat(np.arange(n_ev), n_waits)
+        wait_pos = np.arange(wait_ev.size) - np.repeat(np.cumsum(n_waits) - n_waits, n_waits)
+        wait_data = np.where(wait_pos < full_waits[wait_ev], COUNTER_MAX, rem[wait_ev] - 3)
+        words[ev_starts[wait_ev] + wait_pos] = instas(IWAIT, wait_data)
+
+    # position of each buffer write within its event
+    b_ev = np.repeat(np.arange(n_ev), ev_counts)
+    b_instrs = ev_counts[b_ev]
+    m = np.arange(b_ev.size) - np.repeat(np.cumsum(ev_counts) - ev_counts, ev_counts)
+
+    # time until each buffer will be empty: buffers keep outputting
+    # data until the requested time of the last write to them
+    start_time = (ev_times - ev_counts)[b_ev] # when the instructions of this event begin executing
+    order = np.lexsort((b_ev, ev_bufs))
+    last_time = np.empty(b_ev.size, dtype=np.int64)
+    last_time[order] = np.concatenate([[0], (ev_times + ev_offsets)[b_ev[order]][:-1]])
+    first_write = np.ones(b_ev.size, dtype=bool)
+    first_write[order[1:]] = ev_bufs[order[1:]] != ev_bufs[order[:-1]]
+    last_time[first_write] = buf_times[ev_bufs[first_write]]
+    btl = np.maximum(last_time - start_time, 0)
+
+    # buffer empty for this instruction; need an appropriate delay only for sync
+    # (check against m since with successive cycles, remaining buffers will empty out)
+    buf_empty = btl <= m
+    this_time_offset = ev_offsets[b_ev]
+    extra_delay = np.where(buf_empty, b_instrs - m - 1 + this_time_offset, this_time_offset - btl + b_instrs - 1)
+    words[ev_starts[b_ev] + n_waits[b_ev] + n_nops[b_ev] + m] = instbs(ev_bufs, extra_delay, ev_vals)
+
+    buf_times = buf_times.copy()
+    buf_times[ev_bufs[order]] = (ev_times + ev_offsets)[b_ev[order]] # last write to each buffer wins
+    t_last = ev_times[-1] if n_ev else t_prev
+    return words, t_last, buf_times
 
 CIC_SLOWEST_RATE_NEAREST_POW2 = 1 << np.ceil(np.log2(CIC_SLOWEST_RATE)).astype(int)
 
@@ -466,5 +949,70 @@ def cic_words(rate, set_cic_shift=False):
     else:
         return (b,), excess_factor
 
+## Regression test: the machine code dict2bin() produces for a few
+## representative sequences, compared with that produced for them by
+## the original loop-based compiler, stored in data/dict2bin_expected.npz.
+## Run with: python -c "import marcompile; marcompile.test_dict2bin()"
+
+def test_sequences():
+    """ Cases for test_dict2bin(): name -> (grad board, sequence dictionary, initial buffers, latencies) """
+    zero_bufs, zero_lat = np.zeros(MARGA_BUFS, dtype=np.uint16), np.zeros(MARGA_BUFS, dtype=np.int32)
+    spi_bufs = zero_bufs.copy()
+    spi_bufs[0] = (1 << 0) | (2 << 2) # strobe LSBs, SPI divider 2
+    grad_lat = zero_lat.copy()
+    grad_lat[list(grad_data_bufs)] = 268
+
+    t = np.arange(20)
+    ramp = (np.abs(np.arange(40) - 20) * 1500).astype(np.int64)
+    pulse = {'tx0_i': (1000 + 40 * t, 3000 * t), 'tx0_q': (1000 + 40 * t, 60000 - 3000 * t),
+             'tx_gate': (np.array([900, 1900]), np.array([1, 0])),
+             'rx_gate': (np.array([2000, 6000]), np.array([1, 0])),
+             'rx0_en': (np.array([2100, 5900]), np.array([1, 0])),
+             'lo0_freq': (np.array([100]), np.array([0x1234567])), 'lo0_rst': (np.array([100, 101]), np.array([1, 0])),
+             'leds': (np.array([100, 3000, 6000]), np.array([1, 128, 255]))}
+    # many buffers changing on the same cycles, so that some changes have to be delayed
+    simultaneous = {k: (np.array([200, 201, 202, 400]), np.array([1, 0, 1, 0])) for k in
+                    ['tx_gate', 'rx_gate', 'trig_out', 'rx0_en', 'rx1_en', 'rx2_en', 'rx3_en',
+                     'rx0_rst_n', 'rx1_rst_n', 'lo0_rst', 'lo1_rst', 'lo2_rst']}
+    simultaneous['tx1_i'] = (np.array([200, 201, 300]), np.array([5, 6, 7]))
+    long_waits = {'tx_gate': (np.array([100, 100 + (1 << 25), 200 + (1 << 26)]), np.array([1, 0, 1])),
+                  'leds': (np.array([50, 1 << 24]), np.array([3, 4]))}
+    ocra40 = {f'ocra40_v{ch}': (500 + ch * 7 + 1000 * np.arange(40), (ch << 25) | 0x00100000 | (ramp + 100 * ch) << 2)
+              for ch in range(6)}
+    fhdo = {k: (500 + 25 * ch + 800 * np.arange(40), 0x80000 | (ch << 16) | (ramp + 50 * ch))
+            for ch, k in enumerate(['fhdo_vx', 'fhdo_vy', 'fhdo_vz', 'fhdo_vz2'])}
+    ocra1 = {k: (500 + 1000 * np.arange(40), (ramp + 50 * ch) << 2)
+             for ch, k in enumerate(['ocra1_vx', 'ocra1_vy', 'ocra1_vz', 'ocra1_vz2'])}
+    return {'pulse': ('ocra40', pulse, zero_bufs, zero_lat),
+            'simultaneous': ('ocra40', simultaneous, zero_bufs, zero_lat),
+            'long_waits': ('ocra40', long_waits, zero_bufs, zero_lat),
+            'ocra40': ('ocra40', {**ocra40, **pulse}, spi_bufs, grad_lat),
+            'gpa-fhdo': ('gpa-fhdo', fhdo, spi_bufs, grad_lat),
+            'ocra1': ('ocra1', ocra1, spi_bufs, zero_lat)}
+
+def test_dict2bin(expected_path=None):
+    """ Check that dict2bin() output is bit-identical to the stored machine code for each test case """
+    global grad_board
+    if expected_path is None:
+        expected_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'dict2bin_expected.npz')
+    expected = np.load(expected_path)
+    old_board = grad_board
+    try:
+        for name, (board, sd, initial_bufs, latencies) in test_sequences().items():
+            grad_board = board
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore') # some of the cases are expected to warn
+                words = np.asarray(dict2bin(sd, initial_bufs, latencies), dtype=np.uint32)
+            exp = expected[name]
+            assert words.size == exp.size, "{:s}: {:d} words, expected {:d}".format(name, words.size, exp.size)
+            diff = np.flatnonzero(words != exp)
+            assert diff.size == 0, "{:s}: word {:d} is 0x{:08x}, expected 0x{:08x}".format(name, diff[0], words[diff[0]], exp[diff[0]])
+            print("{:s}: {:d} words match".format(name, words.size))
+    finally:
+        grad_board = old_board
+
 if __name__ == "__main__":
     csv2bin("/tmp/marga.csv")
+
+    if False:
+        test_dict2bin()
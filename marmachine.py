@@ -4,6 +4,8 @@
 # Functions should be fast, without any floating-point arithmetic -
 # that should be handled at a higher level.
 
+import numpy as np
+
 class MarUserWarning(UserWarning):
     pass
 
@@ -75,3 +77,18 @@ def instb(tgt, delay, data):
     assert 0 <= delay <= 255, "Delay out of range"
     assert (data & 0xffff) == (data & 0xffffffff), "Data out of range"
     return (IDATA << 24) | ( (tgt & 0x7f) << 24 ) | ( (delay & 0xff) << 16 ) | (data & 0xffff)
+
+def instas(instr, data):
+    """ Array version of insta(); range checks are done once for the whole array """
+    assert instr in [INOP, IFINISH, IWAIT, ITRIG, ITRIGFOREVER], "Unknown instruction"
+    data = np.asarray(data, dtype=np.int64)
+    assert np.all( (data & COUNTER_MAX) == (data & 0xffffffff) ), "Data out of range"
+    return ( (instr << 24) | (data & 0xffffff) ).astype(np.uint32)
+
+def instbs(tgt, delay, data):
+    """ Array version of instb(); range checks are done once for the whole array """
+    tgt, delay, data = (np.asarray(k, dtype=np.int64) for k in (tgt, delay, data))
+    assert np.all(tgt <= 24), "Unknown target buffer"
+    assert np.all( (0 <= delay) & (delay <= 255) ), "Delay out of range"
+    assert np.all( (data & 0xffff) == (data & 0xffffffff) ), "Data out of range"
+    return ( (IDATA << 24) | ( (tgt & 0x7f) << 24 ) | ( (delay & 0xff) << 16 ) | (data & 0xffff) ).astype(np.uint32)
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+# Local stand-in for the marga server, for testing the client without hardware
+#
+# Speaks the same msgpack protocol as the real server and answers the
+# commands used by the client (regrd, direct, run_seq, read_rx,
+# halt_and_reset, are_you_real, test_throughput), handling each
+# connection's packets one after another. Nothing is actually
+# executed: registers read back as idle (unless set_busy() is used),
+# direct writes are only logged, and run_seq returns random RX data,
+# either as integer lists or as raw byte strings.
+#
+# Usage: python mock_server.py [--port 11111] [--latency 0.001] [--rx-format bytes]
+#
+# or in a test: server = mock_server.start(); ...; server.shutdown()
+
+import argparse, socketserver, threading, time
+import msgpack
+import numpy as np
+
+import server_comms as sc
+
+class MockHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        server = self.server
+        unpacker = msgpack.Unpacker()
+        while True:
+            buf = self.request.recv(65536)
+            if not buf:
+                return
+            if server.latency:
+                time.sleep(server.latency) # network round trip, once for everything that arrived together
+            unpacker.feed(buf)
+            replies = []
+            for packet in unpacker:
+                command, packet_idx = packet[0], packet[1]
+                if command == sc.close_server_pkt:
+                    threading.Thread(target=server.shutdown).start()
+                    return
+                replies.append(msgpack.packb(server.reply(packet_idx, packet[4])))
+            self.request.sendall(b''.join(replies))
+
+class MockServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    """ latency: delay in seconds before answering each batch of packets received together
+    rx_samples: number of samples returned for RX0 and RX1 by run_seq
+    rx_format: 'list' or 'bytes' for the RX and test_throughput arrays """
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address, latency=0, rx_samples=1000, rx_format='list'):
+        super().__init__(address, MockHandler)
+        self.latency = latency
+        self.rx_samples = rx_samples
+        self.rx_format = rx_format
+        self.counts = {} # number of each command received
+        self.directs = [] # arguments of the direct commands received, in order
+        self._busy = range(0) # indices of the regrd commands answered with the grad interfaces busy
+        self._rng = np.random.default_rng()
+        self._lock = threading.Lock()
+
+    def set_busy(self, n, after=0):
+        """ Answer n regrd commands with the grad interfaces busy, after the next `after` ones """
+        with self._lock:
+            first = self.counts.get('regrd', 0) + after
+            self._busy = range(first, first + n)
+
+    def array(self, a):
+        return a.astype('<u4').tobytes() if self.rx_format == 'bytes' else a.tolist()
+
+    def reply(self, packet_idx, data):
+        reply_data, status = {}, {}
+        for cmd, arg in data.items():
+            with self._lock:
+                idx = self.counts.get(cmd, 0)
+                self.counts[cmd] = idx + 1
+                if cmd == 'direct':
+                    self.directs.append(arg)
+            if cmd == 'regrd':
+                reply_data[cmd] = 0x30000 if idx in self._busy else 0 # OCRA1/OCRA40 and GPA-FHDO busy bits
+            elif cmd in ('direct', 'read_rx'):
+                reply_data[cmd] = 0
+            elif cmd == 'halt_and_reset':
+                reply_data[cmd] = True
+            elif cmd == 'are_you_real':
+                reply_data[cmd] = "simulation"
+            elif cmd == 'run_seq':
+                rx = {}
+                for ch in ('rx0', 'rx1'):
+                    iq = self._rng.integers(-(1 << 20), 1 << 20, (2, self.rx_samples)) & 0xffffffff
+                    rx[ch + '_i'], rx[ch + '_q'] = self.array(iq[0]), self.array(iq[1])
+                reply_data[cmd] = rx
+            elif cmd == 'test_throughput':
+                a = np.arange(arg, dtype=np.uint32)
+                reply_data[cmd] = {'array1': self.array(a), 'array2': self.array(2 * a)}
+            else:
+                status.setdefault('errors', []).append("Unknown command " + str(cmd))
+        return [sc.reply_pkt, packet_idx, 0, sc.version_full, reply_data, status]
+
+def start(port=0, **kwargs):
+    """ Run a mock server on localhost in a background thread; port 0 picks a free port (see server.server_address) """
+    server = MockServer(('localhost', port), **kwargs)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local stand-in for the marga server")
+    parser.add_argument('--port', type=int, default=11111)
+    parser.add_argument('--latency', type=float, default=0, help="delay before each reply, s")
+    parser.add_argument('--rx-samples', type=int, default=1000)
+    parser.add_argument('--rx-format', choices=['list', 'bytes'], default='list')
+    args = parser.parse_args()
+
+    server = MockServer(('', args.port), args.latency, args.rx_samples, args.rx_format)
+    print("Mock marga server listening on port {:d}".format(args.port))
+    server.serve_forever()
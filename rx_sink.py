@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+# Append-only, memory-mapped storage for the RX data of many runs
+#
+# Each RX channel's samples go into a raw file of complex values,
+# which is preallocated and grown in large steps, so that long
+# acquisitions (e.g. overnight) use a constant amount of RAM. A record
+# of each run -- where its samples are, the RX sampling times, LO
+# frequencies and CIC factors -- is appended to a separate file once
+# the run's data has been written, so the sink can be read back with
+# load() while it is still being filled.
+
+import json, os, time
+import numpy as np
+
+rx_channels = ('rx0', 'rx1', 'rx2', 'rx3')
+
+run_dtype = np.dtype([('offset', np.int64, len(rx_channels)), # first sample of the run in each channel's file
+                      ('length', np.int64, len(rx_channels)), # number of samples; 0 if the channel wasn't used
+                      ('rx_t', np.float64, 2), # RX sampling times, us
+                      ('lo_freq', np.float64, 3), # LO frequencies, MHz
+                      ('cic_factor', np.float64, 2), # CIC scale corrections for RX0/2 and RX1/3
+                      ('time', np.float64)]) # Unix time at the end of the run
+
+class RxSink:
+    """ Sink for the RX data of many runs, stored in the directory path.
+
+    capacity: number of samples initially allocated for each channel; the files grow by doubling when full
+    dtype: complex type of the stored samples; complex64 by default for a new sink, and must match an existing one's
+    """
+
+    def __init__(self, path, capacity=1 << 20, dtype=None):
+        self._path = path
+        os.makedirs(path, exist_ok=True)
+        header_path = os.path.join(path, 'sink.json')
+        if os.path.exists(header_path):
+            # carry on appending to an existing sink
+            with open(header_path) as f:
+                stored = np.dtype(json.load(f)['dtype'])
+            assert dtype is None or np.dtype(dtype) == stored, \
+                "The sink in {:s} stores {:s} samples, not {:s}".format(path, str(stored), str(np.dtype(dtype)))
+            dtype = stored
+        else:
+            if dtype is None:
+                dtype = np.complex64
+            with open(header_path, 'w') as f:
+                json.dump({'dtype': np.dtype(dtype).str, 'channels': rx_channels}, f)
+
+        self._dtype = np.dtype(dtype)
+        self._capacity = capacity
+        self._maps = {} # memory map of each channel's file
+        self._sizes = {ch: 0 for ch in rx_channels} # samples written to each channel
+        runs = load_runs(path)
+        for k, ch in enumerate(rx_channels):
+            if runs.size:
+                self._sizes[ch] = int(np.max(runs['offset'][:, k] + runs['length'][:, k]))
+        self._run = None # record of the run being written
+
+    def _map(self, ch, size):
+        """ Memory map of a channel's file, grown to hold at least size samples """
+        mm = self._maps.get(ch)
+        if mm is not None and mm.size >= size:
+            return mm
+
+        path = os.path.join(self._path, ch + '.dat')
+        old_size = os.path.getsize(path) // self._dtype.itemsize if os.path.exists(path) else 0
+        new_size = max(old_size, self._capacity)
+        while new_size < size:
+            new_size *= 2
+        if mm is not None:
+            mm.flush()
+            del self._maps[ch]
+        with open(path, 'ab') as f:
+            f.truncate(new_size * self._dtype.itemsize)
+        self._maps[ch] = np.memmap(path, dtype=self._dtype, mode='r+', shape=(new_size,))
+        return self._maps[ch]
+
+    def begin_run(self, rx_t=(0, 0), lo_freq=(0, 0, 0), cic_factor=(1, 1)):
+        """ Start recording a run, with its settings; any unfinished run is abandoned """
+        self.abort_run()
+        self._run = np.zeros(1, dtype=run_dtype)
+        self._run['offset'] = [self._sizes[ch] for ch in rx_channels]
+        self._run['rx_t'], self._run['lo_freq'], self._run['cic_factor'] = rx_t, lo_freq, cic_factor
+
+    def reserve(self, ch, n):
+        """ Space for n samples of channel ch in the current run, to be filled in directly """
+        assert self._run is not None, "begin_run() must be called first"
+        k = rx_channels.index(ch)
+        assert self._run['length'][0, k] == 0, "RX channel {:s} was already written in this run".format(ch)
+        start = self._sizes[ch]
+        self._run['length'][0, k] = n
+        self._sizes[ch] = start + n
+        return self._map(ch, start + n)[start:start + n]
+
+    def end_run(self):
+        """ Flush the run's data to disk, then record the run """
+        for mm in self._maps.values():
+            mm.flush()
+        self._run['time'] = time.time()
+        with open(os.path.join(self._path, 'runs.dat'), 'ab') as f:
+            f.write(self._run.tobytes())
+        self._run = None
+
+    def abort_run(self):
+        """ Abandon the current run, e.g. after an error while writing it;
+        its space is reused by the next run, and it's never recorded """
+        if self._run is not None:
+            for k, ch in enumerate(rx_channels):
+                self._sizes[ch] = int(self._run['offset'][0, k])
+            self._run = None
+
+    def write(self, rxd, **settings):
+        """ Record a run from a dictionary of RX arrays, as returned by Experiment.run() """
+        self.begin_run(**settings)
+        try:
+            for ch, data in rxd.items():
+                self.reserve(ch, data.size)[:] = data
+        except BaseException:
+            self.abort_run()
+            raise
+        self.end_run()
+
+    def close(self):
+        for mm in self._maps.values():
+            mm.flush()
+        self._maps.clear()
+
+def load_runs(path):
+    """ Records of the runs completed so far """
+    try:
+        return np.fromfile(os.path.join(path, 'runs.dat'), dtype=run_dtype)
+    except FileNotFoundError:
+        return np.zeros(0, dtype=run_dtype)
+
+def load(path):
+    """ Open a sink for reading, which may still be being written to.
+    Returns the run records, and a read-only memory map of each channel's
+    samples. Samples beyond the last completed run may not be valid yet. """
+    with open(os.path.join(path, 'sink.json')) as f:
+        dtype = np.dtype(json.load(f)['dtype'])
+    data = {}
+    for ch in rx_channels:
+        ch_path = os.path.join(path, ch + '.dat')
+        if os.path.exists(ch_path) and os.path.getsize(ch_path):
+            data[ch] = np.memmap(ch_path, dtype=dtype, mode='r')
+    return load_runs(path), data
+
+def run_data(runs, data, idx):
+    """ Dictionary of the RX arrays for run idx, from the output of load() """
+    rxd = {}
+    for k, ch in enumerate(rx_channels):
+        offset, length = runs['offset'][idx, k], runs['length'][idx, k]
+        if length:
+            rxd[ch] = data[ch][offset:offset + length]
+    return rxd
+
+if __name__ == "__main__":
+    import sys
+    runs, data = load(sys.argv[1])
+    print("{:d} runs".format(runs.size))
+    for ch, mm in data.items():
+        k = rx_channels.index(ch)
+        print("{:s}: {:d} samples".format(ch, int(runs['length'][:, k].sum())))
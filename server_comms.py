@@ -1,6 +1,6 @@
 #!/usr/bin/env python3
 
-import msgpack, warnings
+import asyncio, msgpack, threading, time, warnings, weakref
 
 from marmachine import MarServerWarning
 
@@ -58,24 +58,62 @@ def construct_packet(data, packet_idx=0, command=request_pkt, version=(version_m
 #         print("Reply data: ")
 #         print(reply_data)
 
-def send_packet(packet, socket):
-    socket.sendall(msgpack.packb(packet))
+def count(stats, bytes_sent=0, bytes_received=0, round_trips=0):
+    """ Add to the counts in an optional stats dictionary """
+    if stats is not None:
+        for k, n in (('bytes_sent', bytes_sent), ('bytes_received', bytes_received), ('round_trips', round_trips)):
+            if n:
+                stats[k] = stats.get(k, 0) + n
 
-    unpacker = msgpack.Unpacker()
-    packet_done = False
-    while not packet_done:
-        buf = socket.recv(1024)
-        if not buf:
-            break
-        unpacker.feed(buf)
-        for o in unpacker: # ugly way of doing it
-            return o # quit function after 1st reply (could make this a thread in the future)
+class Receiver:
+    """Reads msgpack replies from a socket through one unpacker and a
+    large preallocated receive buffer, both reused between replies; any
+    bytes received after the end of a reply are kept for the next one"""
 
-def command(server_dict, socket, print_infos=False, assert_errors=False):
-    packet = construct_packet(server_dict)
-    reply = send_packet(packet, socket)
-    return_status = reply[5]
+    def __init__(self, bufsize=1 << 20):
+        self._buf = memoryview(bytearray(bufsize))
+        self._unpacker = msgpack.Unpacker(max_buffer_size=0) # no limit on the reply size
+
+    def reply(self):
+        """ Next complete reply received, or None if more data are needed """
+        try:
+            return next(self._unpacker)
+        except StopIteration:
+            return None
+
+    def feed(self, data, stats=None):
+        count(stats, bytes_received=len(data))
+        self._unpacker.feed(data)
+
+    def recv(self, socket, stats=None):
+        """ Next reply from the socket, or None if the connection was closed first """
+        while True:
+            reply = self.reply()
+            if reply is not None:
+                return reply
+            n = socket.recv_into(self._buf)
+            if n == 0:
+                return None
+            self.feed(self._buf[:n], stats)
+
+_receivers = weakref.WeakKeyDictionary()
+
+def receiver(socket):
+    """ The Receiver for a socket, kept as long as the socket exists """
+    try:
+        return _receivers[socket]
+    except KeyError:
+        return _receivers.setdefault(socket, Receiver())
+
+def send_packet(packet, socket, stats=None):
+    """ stats: optional dictionary in which to count the bytes sent and received, and the round trips """
+    data = msgpack.packb(packet)
+    socket.sendall(data)
+    count(stats, bytes_sent=len(data), round_trips=1)
+    return receiver(socket).recv(socket, stats)
 
+def check_status(return_status, print_infos=False, assert_errors=False):
+    """ Print, warn about or raise the infos, warnings and errors in a server reply's status """
     if print_infos and 'infos' in return_status:
         print("Server info:")
         for k in return_status['infos']:
@@ -92,4 +130,147 @@ def command(server_dict, socket, print_infos=False, assert_errors=False):
             for k in return_status['errors']:
                 warnings.warn("SERVER ERROR: " + k, RuntimeWarning)
 
+def command(server_dict, socket, print_infos=False, assert_errors=False, stats=None):
+    packet = construct_packet(server_dict)
+    reply = send_packet(packet, socket, stats)
+    return_status = reply[5]
+    check_status(return_status, print_infos, assert_errors)
     return reply, return_status
+
+def command_batch(server_dicts, socket, print_infos=False, assert_errors=False, stats=None, window=256):
+    """Send a list of commands, pipelined: up to window packets are sent
+    before waiting for their replies, so the whole list only takes
+    about len(server_dicts) / window round trips. The server handles
+    the packets one after another as usual.
+
+    Returns a list of (reply, return_status) tuples, in the same order as server_dicts"""
+    results = []
+    rcv = receiver(socket)
+    for data, n in batch_windows(server_dicts, window, stats):
+        socket.sendall(data)
+        for k in range(n):
+            results.append(batch_reply(rcv.recv(socket, stats), n - k, print_infos, assert_errors))
+    return results
+
+def batch_windows(server_dicts, window, stats=None):
+    """ Packed packets for each window of a command batch, with the number of commands in it """
+    for start in range(0, len(server_dicts), window):
+        chunk = server_dicts[start:start + window]
+        data = b''.join(msgpack.packb(construct_packet(d, start + k)) for k, d in enumerate(chunk))
+        count(stats, bytes_sent=len(data), round_trips=1)
+        yield data, len(chunk)
+
+def batch_reply(reply, outstanding, print_infos=False, assert_errors=False):
+    """ Check a reply to a command batch, with outstanding replies still expected including this one """
+    assert reply is not None, "Server closed the connection with {:d} replies outstanding".format(outstanding)
+    check_status(reply[5], print_infos, assert_errors)
+    return reply, reply[5]
+
+class AsyncConnection:
+    """asyncio connection to the server, so that a sequence can be run
+    while other tasks (e.g. instrument I/O) carry on in the same event
+    loop. Commands from several tasks are sent one at a time.
+
+    If a command is cancelled or times out before its replies have
+    arrived, the connection is closed, since the replies would otherwise
+    be taken for those of the next command.
+
+    Create with: conn = await AsyncConnection.open(ip_address, port)
+    """
+
+    def __init__(self, reader, writer):
+        self._reader, self._writer = reader, writer
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread = threading.get_ident()
+        self._lock = asyncio.Lock()
+        self._receiver = Receiver(0) # only its unpacker is used
+
+    @classmethod
+    async def open(cls, host, port):
+        reader, writer = await asyncio.open_connection(host, port)
+        return cls(reader, writer)
+
+    async def _recv(self, stats=None):
+        """ asyncio version of Receiver.recv() """
+        while True:
+            reply = self._receiver.reply()
+            if reply is not None:
+                return reply
+            buf = await self._reader.read(1 << 20)
+            if not buf:
+                return None
+            self._receiver.feed(buf, stats)
+
+    async def _command_batch(self, server_dicts, print_infos, assert_errors, stats, window):
+        results = []
+        for data, n in batch_windows(server_dicts, window, stats):
+            self._writer.write(data)
+            await self._writer.drain()
+            for k in range(n):
+                results.append(batch_reply(await self._recv(stats), n - k, print_infos, assert_errors))
+        return results
+
+    async def command_batch(self, server_dicts, print_infos=False, assert_errors=False, stats=None, timeout=None, window=256):
+        """ asyncio version of command_batch(); timeout in seconds for all the replies to arrive """
+        async with self._lock:
+            try:
+                return await asyncio.wait_for(self._command_batch(server_dicts, print_infos, assert_errors, stats, window), timeout)
+            except (asyncio.CancelledError, asyncio.TimeoutError):
+                self.close() # replies may still be on their way
+                raise
+
+    async def command(self, server_dict, print_infos=False, assert_errors=False, stats=None, timeout=None):
+        """ asyncio version of command() """
+        return (await self.command_batch([server_dict], print_infos, assert_errors, stats, timeout))[0]
+
+    async def close_server(self):
+        """ Ask the server to shut down, then close the connection """
+        async with self._lock:
+            self._writer.write(msgpack.packb(construct_packet({}, 0, command=close_server_pkt)))
+            await self._writer.drain()
+            self.close()
+
+    def _sync(self, coro):
+        """ Run a coroutine in the connection's event loop from another thread, and wait for its result """
+        if threading.get_ident() == self._loop_thread:
+            coro.close()
+            raise RuntimeError("Blocking commands can't be sent from the event loop thread; use the async methods instead")
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result()
+
+    def sync_command(self, server_dict, print_infos=False, assert_errors=False, stats=None):
+        """ Blocking command() over this connection, for code running in
+        a worker thread (e.g. with asyncio.to_thread) rather than in the event loop """
+        return self._sync(self.command(server_dict, print_infos, assert_errors, stats))
+
+    def sync_command_batch(self, server_dicts, print_infos=False, assert_errors=False, stats=None):
+        """ Blocking command_batch() over this connection, see sync_command() """
+        return self._sync(self.command_batch(server_dicts, print_infos, assert_errors, stats))
+
+    def sync_close_server(self):
+        """ Blocking close_server(), see sync_command() """
+        return self._sync(self.close_server())
+
+    def close(self):
+        self._writer.close()
+
+def test_throughput(sizes_MB=(1, 10, 100), rx_format='bytes'):
+    """ Time replies of increasing size from a local mock server """
+    import socket as sk
+    import mock_server
+    server = mock_server.start(rx_format=rx_format)
+    s = sk.create_connection(server.server_address)
+    try:
+        for size in sizes_MB:
+            n = int(size * 1e6) // 8 # two uint32 arrays
+            t0 = time.perf_counter()
+            reply, _ = command({'test_throughput': n}, s)
+            dt = time.perf_counter() - t0
+            tp = reply[4]['test_throughput']
+            assert len(tp['array1']) == (4 * n if rx_format == 'bytes' else n), "Reply has the wrong size"
+            print("{:7.1f} MB reply: {:.3f} s, {:.1f} MB/s".format(size, dt, size / dt))
+    finally:
+        s.close()
+        server.shutdown()
+
+if __name__ == "__main__":
+    test_throughput()